@@ -0,0 +1,72 @@
+"""
+Batch job that precomputes the clustered search results of the most frequently
+used tags and tag pairs, so the web app can serve those queries without running
+OPTICS.  Results (cluster labels, IDs and centroids) are stored in the
+``precomputed_clusters`` folder of ``FLICKR_TABLES_FOLDER``, which the web app
+reads on a cache miss.  Their OPTICS fits are also saved to the
+``reachability`` folder, so changes to the cluster extraction can be rerun
+without refitting.
+
+To use, run on the command line::
+
+    python run_precompute_clusters.py [--n-tags N] [--n-pairs N]
+        [--n-candidates N] [--processes N] [-v]
+
+where
+
+--n-tags : int, optional
+    Number of most frequent tags to precompute.  Default: 100.
+--n-pairs : int, optional
+    Number of most frequent tag pairs to precompute.  Default: 100.
+--n-candidates : int, optional
+    Tag pairs are drawn from this many of the most frequent tags.  Default:
+    200.
+--processes : int, optional
+    Number of worker processes.  Default: number of CPUs.
+-v, --verbose : flag, optional
+    Print status during run.
+"""
+
+import multiprocessing
+
+from snapassist.webapp import db, views
+
+
+def precompute_clusters(phrases, processes=None, verbose=False):
+    with multiprocessing.Pool(processes) as pool:
+        for key, clusters in pool.imap_unordered(views.compute_clusters,
+                                                 phrases):
+            if clusters is None:
+                if verbose:
+                    print("Skipping {0}: not enough results".format(key))
+                continue
+            views.save_precomputed_clusters(key, clusters)
+            if verbose:
+                labels, ids, centroids = clusters
+                print("Stored {0}: {1} photos, {2} clusters".format(
+                    key, len(labels), len(ids)))
+
+
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--n-tags", type=int, default=100,
+                        help="Number of most frequent tags to precompute.")
+    parser.add_argument("--n-pairs", type=int, default=100,
+                        help="Number of most frequent tag pairs to "
+                             "precompute.")
+    parser.add_argument("--n-candidates", type=int, default=200,
+                        help="Number of most frequent tags to draw pairs "
+                             "from.")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Number of worker processes.")
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print status during run.")
+    args = parser.parse_args()
+
+    phrases = db.frequent_phrases(n_tags=args.n_tags, n_pairs=args.n_pairs,
+                                  n_candidates=args.n_candidates)
+    precompute_clusters(phrases, processes=args.processes,
+                        verbose=args.verbose)
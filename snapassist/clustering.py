@@ -19,15 +19,21 @@ class Clustering:
         self.longitude_coeff = np.sin(
             self.ref_longlat.latitude * np.pi / 180.)
         self.global_min_samples = operator.index(global_min_samples)
+        # Fitted OPTICS estimator from the last `optics_clustering` call.
+        self.optics_ = None
 
     def feature_scaling(self):
         # Standard feature scaling.
         photos_longlat = self.table[['longitude', 'latitude']].values
 
-        X = StandardScaler().fit_transform(photos_longlat)
+        scaler = StandardScaler()
+        X = scaler.fit_transform(photos_longlat)
         # Scale longitude features as a first approximation of great circle
         # distance.
         X[:, 0] *= self.longitude_coeff
+        # Factors long/lat distances are multiplied by in X.
+        self.feature_scale_ = (np.array([self.longitude_coeff, 1.]) /
+                               scaler.scale_)
         return X
 
     def dbscan_clustering(self):
@@ -47,7 +53,86 @@ class Clustering:
         db = DBSCAN(eps=eps, min_samples=min_samples).fit(X)
         self.table['cluster'] = db.labels_
 
-    def optics_clustering(self, max_eps_scaling=1.):
+    def grid_clustering(self, n_cells=200, eps_cells=1.5):
+        """Cluster photos after pre-aggregating them onto a grid.
+
+        Photos are binned into square cells of the scaled features, with
+        `n_cells` cells across their mean range.  The occupied cells are then
+        clustered with DBSCAN, each weighted by its number of photos, and
+        photos take the label of their cell.  A cell is a core cell if there
+        are at least as many photos as `optics_clustering`'s `min_samples`
+        within `eps_cells` cell widths of it (its 3x3 block by default).
+
+        Runs in O(n log n) time, so it is suited to search results too large
+        for OPTICS.  Results are stored in `self.table['cluster']`.
+
+        Parameters
+        ----------
+        n_cells : int, optional
+            Number of cells across the mean range of the features.  Default:
+            200.
+        eps_cells : float, optional
+            DBSCAN `eps`, in cell widths.  Default: 1.5.
+        """
+        # Feature scaling.
+        X = self.feature_scaling()
+
+        min_samples = max([self.global_min_samples, int(0.005 * X.shape[0])])
+        cell_size = np.mean([(X[:, 0].max() - X[:, 0].min()),
+                             (X[:, 1].max() - X[:, 1].min())]) / n_cells
+        if cell_size == 0.:
+            # All photos are at the same spot.
+            cell_size = 1.
+
+        cells = np.floor((X - X.min(axis=0)) / cell_size).astype(np.int64)
+        cell_keys = cells[:, 0] * (cells[:, 1].max() + 1) + cells[:, 1]
+        _, first, inverse, counts = np.unique(
+            cell_keys, return_index=True, return_inverse=True,
+            return_counts=True)
+        cell_centers = (cells[first] + 0.5) * cell_size
+
+        db = DBSCAN(eps=eps_cells * cell_size, min_samples=min_samples).fit(
+            cell_centers, sample_weight=counts)
+        self.optics_ = None
+        self.table['cluster'] = db.labels_[inverse]
+
+    def optics_clustering(self, max_eps_scaling=1., fit=None,
+                          spatial_index=None, rows=None, max_graph_size=None,
+                          grid_threshold=None):
+        """Cluster with OPTICS.
+
+        Parameters
+        ----------
+        max_eps_scaling : float, optional
+            OPTICS `max_eps`, in units of the mean range of the scaled
+            features.  Default: 1.
+        fit : dict, optional
+            Arrays returned by `get_optics_fit` for an earlier fit of the same
+            table with the same `max_eps_scaling`.  If given, clusters are
+            extracted from these rather than refitting.
+        spatial_index : spatial.SpatialIndex, optional
+            Index over all photos.  If given, neighborhoods are found with it
+            rather than with a tree built on `self.table`.
+        rows : numpy.ndarray, optional
+            Positions of the rows of `self.table` in `spatial_index`.
+        max_graph_size : int, optional
+            If the neighbors graph of `self.table` can't have more than this
+            many entries (``len(self.table)**2``), it is precomputed from a
+            tree built on `self.table`, so OPTICS orders points in Cython
+            without holding the GIL.  Otherwise, neighborhoods are found with
+            `spatial_index` if they are estimated to need at most this many
+            candidate pairs, or else queried point by point.  If `None`
+            (default), `spatial_index` is always used if given.
+        grid_threshold : int, optional
+            If `self.table` has more rows than this, and no `fit` is given,
+            `grid_clustering` is run instead of OPTICS.  If `None` (default),
+            OPTICS is always run.
+        """
+        if (fit is None and grid_threshold is not None and
+                len(self.table) > grid_threshold):
+            self.grid_clustering()
+            return
+
         # Feature scaling.
         X = self.feature_scaling()
 
@@ -55,10 +140,76 @@ class Clustering:
         max_eps = max_eps_scaling * np.mean([(X[:, 0].max() - X[:, 0].min()),
                                              (X[:, 1].max() - X[:, 1].min())])
 
-        optcl = optics.OPTICS(min_samples=min_samples, max_eps=max_eps)
-        optcl.fit(X)
+        precompute_neighbors = (fit is None and max_graph_size is not None
+                                and len(X)**2 <= max_graph_size)
+        optcl = optics.OPTICS(min_samples=min_samples, max_eps=max_eps,
+                              precompute_neighbors=precompute_neighbors)
+        if fit is None:
+            graph = None
+            if not precompute_neighbors:
+                graph = self._neighbors_graph(X, max_eps, spatial_index, rows,
+                                              max_graph_size)
+            optcl.fit(X, neighbors_graph=graph)
+        else:
+            optcl.set_reachability(fit['ordering'], fit['reachability'],
+                                   fit['core_distances'])
+        self.optics_ = optcl
         self.table['cluster'] = optcl.labels_
 
+    def _neighbors_graph(self, X, radius, spatial_index, rows,
+                         max_graph_size):
+        # Neighbors graph of X from a shared spatial index, or None if there
+        # isn't one or the graph would be too costly to find.
+        if spatial_index is None:
+            return None
+        if max_graph_size is not None and (spatial_index.estimate_graph_size(
+                rows, self.feature_scale_, radius) > max_graph_size):
+            return None
+        return spatial_index.radius_neighbors_graph(
+            rows, X, self.feature_scale_, radius)
+
+    def get_optics_fit(self):
+        """Arrays of the last OPTICS fit, to pass to `optics_clustering`.
+
+        The ordering is stored as int32 to keep saved fits compact.
+        """
+        self._check_optics_fitted()
+        return {'ordering': self.optics_.ordering_.astype(np.int32),
+                'reachability': self.optics_.reachability_,
+                'core_distances': self.optics_.core_distances_}
+
+    def _check_optics_fitted(self):
+        if self.optics_ is None:
+            raise ValueError("optics_clustering must be run before clusters "
+                             "can be re-extracted.")
+
+    def reextract_optics_clusters(self, **params):
+        """Re-extract clusters from the last OPTICS fit with new parameters.
+
+        Reuses the fitted ordering and reachability distances, so this runs
+        in linear time.  Results are stored in `self.table['cluster']`.
+
+        Parameters
+        ----------
+        **params
+            Extraction parameters of `optics.OPTICS` (eg. `maxima_ratio`,
+            `min_cluster_size`) to override.
+        """
+        self._check_optics_fitted()
+        self.table['cluster'] = self.optics_.extract_optics(**params)[1]
+
+    def reextract_dbscan_clusters(self, eps):
+        """Extract DBSCAN clusters at `eps` from the last OPTICS fit.
+
+        Parameters
+        ----------
+        eps : float
+            DBSCAN neighborhood radius, in scaled feature units (see
+            `feature_scaling`).  Must be smaller than the fit's `max_eps`.
+        """
+        self._check_optics_fitted()
+        self.table['cluster'] = self.optics_.extract_dbscan(eps)[1]
+
     def hdbscan_clustering(self, min_samples_scaling=0.5):
         # Feature scaling.
         X = self.feature_scaling()
@@ -136,30 +287,39 @@ class Clustering:
         ids = []
         centroids = []
 
-        for i in range(self.table['cluster'].max() + 1):
-            c_cluster = self.table[self.table['cluster'] == i]
-
-            c_cluster_llv = c_cluster.loc[:, ['longitude',
-                                              'latitude', 'views']].values
+        labels = self.table['cluster'].values
+        llv = self.table[['longitude', 'latitude', 'views']].values
+        index = self.table.index.values
+        # Sort rows by cluster once (stably, so each cluster's rows stay in
+        # table order), then slice each cluster out of the sorted rows.
+        by_cluster = np.argsort(labels, kind='mergesort')
+        n_clusters = labels.max() + 1 if len(labels) else 0
+        bounds = np.searchsorted(labels[by_cluster], np.arange(n_clusters + 1))
+
+        for i in range(n_clusters):
+            c_rows = by_cluster[bounds[i]:bounds[i + 1]]
+            c_cluster_llv = llv[c_rows]
             c_outliers = self._sigma_trim(c_cluster_llv[:, :2], sigma,
                                           critical_char_dist)
 
             # If, following sigma clipping, the max number of views of any
             # photo in the remaining cluster is too low, remove the whole
             # cluster.
-            if critical_views and (len(c_cluster[~c_outliers]) > 0):
-                if c_cluster.loc[~c_outliers, 'views'].max() < critical_views:
-                    c_outliers = np.ones(len(c_cluster), dtype=bool)
+            if critical_views and not c_outliers.all():
+                if c_cluster_llv[~c_outliers, 2].max() < critical_views:
+                    c_outliers = np.ones(len(c_rows), dtype=bool)
 
             # Add outliers (possibly the whole cluster to the global list).
-            c_outlier_indices = list(c_cluster.index[c_outliers])
-            outliers += c_outlier_indices
+            c_outlier_indices = index[c_rows[c_outliers]]
+            outliers.append(c_outlier_indices)
 
             # If we didn't add the whole cluster, append the cluster ID and
             # centroid.
-            if len(c_outlier_indices) < len(c_cluster):
+            if len(c_outlier_indices) < len(c_rows):
                 ids.append(i)
                 centroids.append(tuple(
                     np.average(c_cluster_llv[~c_outliers, :2], axis=0,
                                weights=c_cluster_llv[~c_outliers, 2])))
-        return np.sort(np.array(outliers)), ids, centroids
\ No newline at end of file
+        if not outliers:
+            return np.array([]), ids, centroids
+        return np.sort(np.concatenate(outliers)), ids, centroids
\ No newline at end of file
@@ -1,6 +1,9 @@
 import pandas as pd
 import numpy as np
+import json
+import os
 import re
+from scipy.sparse import csr_matrix, triu
 
 
 class TorontoLongLat:
@@ -9,45 +12,599 @@ class TorontoLongLat:
     latitude = 43.653963
 
 
-def _contains_all(x, search_args_split, search_args_joined):
-    split_result = all(item in x for item in search_args_split)
-    joined_result = search_args_joined in x
-    return (split_result or joined_result)
+def _reduce_phrase(phrase):
+    """Reduce a search phrase to its split and joined search terms."""
+    phrase_reduced = re.sub('[^0-9A-z\s]', '', phrase.lower())
+    search_args_split = phrase_reduced.split()
+    search_args_joined = "".join(search_args_split)
+    return search_args_split, search_args_joined
+
+
+def canonical_phrase(phrase):
+    """Canonical form of a search phrase, as reduced for tag searches.
+
+    Phrases with the same canonical form have the same search results.
+    """
+    return " ".join(_reduce_phrase(phrase)[0])
+
+
+class EncodedTags:
+    """Integer-encoded photo tags, stored CSR-style.
+
+    The tag IDs of row ``i`` are
+    ``tag_ids[tag_offsets[i]:tag_offsets[i + 1]]``, where IDs are positions in
+    a vocabulary shared between tables.
+
+    Parameters
+    ----------
+    tag_ids : numpy.ndarray
+        Flat int32 array of the tag IDs of every row, in row order.
+    tag_offsets : numpy.ndarray
+        Array of length ``n_rows + 1`` of offsets into `tag_ids`.
+    """
+
+    def __init__(self, tag_ids, tag_offsets):
+        self.tag_ids = np.asarray(tag_ids, dtype=np.int32)
+        self.tag_offsets = np.asarray(tag_offsets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.tag_offsets) - 1
+
+    def __getitem__(self, i):
+        return self.tag_ids[self.tag_offsets[i]:self.tag_offsets[i + 1]]
+
+    @property
+    def nbytes(self):
+        return self.tag_ids.nbytes + self.tag_offsets.nbytes
+
+    def row_positions(self):
+        """Row position of each element of `tag_ids`."""
+        return np.repeat(np.arange(len(self), dtype=np.int32),
+                         np.diff(self.tag_offsets))
+
+
+def encode_tags(*tag_columns):
+    """Encode whitespace-delimited tag strings as `EncodedTags`.
+
+    Parameters
+    ----------
+    *tag_columns : iterable of str
+        Tag strings of each photo, one iterable per table.  All tables share
+        the same vocabulary.
+
+    Returns
+    -------
+    vocabulary : list of str
+        Every distinct tag, sorted; a tag's ID is its position.
+    encoded : list of EncodedTags
+        Encoded tags of each table in `tag_columns`.
+    """
+    lookup = {}
+    encoded = []
+    for tag_strings in tag_columns:
+        tag_ids = []
+        tag_offsets = [0]
+        for tags in tag_strings:
+            tag_ids.extend(lookup.setdefault(tag, len(lookup))
+                           for tag in tags.split())
+            tag_offsets.append(len(tag_ids))
+        encoded.append(EncodedTags(tag_ids, tag_offsets))
+    vocabulary = sorted(lookup)
+    # Renumber tags from first-seen order to sorted order.
+    sorted_ids = np.empty(len(lookup), dtype=np.int32)
+    sorted_ids[[lookup[tag] for tag in vocabulary]] = np.arange(
+        len(vocabulary), dtype=np.int32)
+    encoded = [EncodedTags(sorted_ids[tags.tag_ids], tags.tag_offsets)
+               for tags in encoded]
+    return vocabulary, encoded
+
+
+class SortedVocabulary:
+    """Tag ID lookups by binary search on a sorted array of tags.
+
+    Unlike a dict, needs no Python object per tag, so the array can be
+    memory-mapped and shared between processes.  Tags are stored as UTF-8
+    bytes, which take less space than unicode arrays' four bytes per
+    character, and sort in the same order.
+
+    Parameters
+    ----------
+    tags : numpy.ndarray
+        Every distinct tag, UTF-8 encoded and sorted; a tag's ID is its
+        position.
+    """
+
+    def __init__(self, tags):
+        self.tags = tags
+
+    @classmethod
+    def from_strings(cls, vocabulary):
+        """Create a SortedVocabulary from a sorted list of tag strings."""
+        return cls(np.array([tag.encode('utf-8') for tag in vocabulary],
+                            dtype=bytes))
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, tag_id):
+        return self.tags[tag_id].decode('utf-8')
+
+    def get(self, tag, default=None):
+        """ID of `tag`, or `default` if it isn't in the vocabulary."""
+        tag = tag.encode('utf-8')
+        tag_id = np.searchsorted(self.tags, tag)
+        if tag_id < len(self.tags) and self.tags[tag_id] == tag:
+            return int(tag_id)
+        return default
+
+
+class TagIndex:
+    """Inverted index from tags to the rows of a table containing them.
+
+    Posting lists are stored CSR-style, as a flat array of row positions
+    sorted by tag ID, then position.  Tags are looked up by binary search
+    in the shared sorted vocabulary, and fetching a posting list is then
+    constant time.
+
+    Parameters
+    ----------
+    encoded_tags : EncodedTags
+        Tags of each photo, in table row order.
+    vocabulary : SortedVocabulary
+        Maps tag strings to tag IDs; shared between tables.
+    """
+
+    empty = np.array([], dtype=np.int32)
+
+    def __init__(self, encoded_tags, vocabulary):
+        self.vocabulary = vocabulary
+        self.n_rows = len(encoded_tags)
+
+        # Stable sort keeps positions ascending within each tag.
+        order = np.argsort(encoded_tags.tag_ids, kind='mergesort')
+        tag_ids = encoded_tags.tag_ids[order]
+        positions = encoded_tags.row_positions()[order]
+        # Drop repeated tags within the same photo.
+        unique = np.ones(len(order), dtype=bool)
+        unique[1:] = ((tag_ids[1:] != tag_ids[:-1]) |
+                      (positions[1:] != positions[:-1]))
+        self.postings = positions[unique]
+        self.posting_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(tag_ids[unique], minlength=len(vocabulary)),
+                  out=self.posting_offsets[1:])
+
+    @classmethod
+    def from_postings(cls, postings, posting_offsets, vocabulary, n_rows):
+        """Create a TagIndex from precomputed posting list arrays."""
+        tag_index = cls.__new__(cls)
+        tag_index.vocabulary = vocabulary
+        tag_index.n_rows = n_rows
+        tag_index.postings = postings
+        tag_index.posting_offsets = posting_offsets
+        return tag_index
+
+    def lookup(self, tag):
+        """Sorted row positions whose tags contain `tag`."""
+        tag_id = self.vocabulary.get(tag)
+        if tag_id is None:
+            return self.empty
+        return self.postings[self.posting_offsets[tag_id]:
+                             self.posting_offsets[tag_id + 1]]
+
+    def search(self, search_args_split, search_args_joined):
+        """Row positions whose tags contain all of `search_args_split`, or
+        `search_args_joined`."""
+        if not search_args_split:
+            return np.arange(self.n_rows, dtype=np.int32)
+        postings = [self.lookup(tag) for tag in search_args_split]
+        # Intersect shortest lists first to keep intermediate results small.
+        postings.sort(key=len)
+        positions = postings[0]
+        for item in postings[1:]:
+            if not len(positions):
+                break
+            positions = np.intersect1d(positions, item, assume_unique=True)
+        # For single-word phrases the joined phrase is the split one.
+        if len(search_args_split) > 1:
+            positions = np.union1d(positions,
+                                   self.lookup(search_args_joined))
+        return positions
+
+
+# Main table columns needed by the web app, which `build_search_bundle` stores
+# so they can be memory-mapped and shared between processes.
+shared_columns = ('id', 'owner', 'longitude', 'latitude', 'views', 'url_s',
+                  'width_s', 'height_s')
+
+
+class ColumnStore:
+    """Table held as a set of (possibly memory-mapped) column arrays.
+
+    String columns are stored as UTF-8 encoded fixed-width bytes, and decoded
+    only for the rows that are taken.
+
+    Parameters
+    ----------
+    columns : dict
+        Maps column names to equal-length arrays.
+    index : numpy.ndarray
+        Index labels of the rows.
+    """
+
+    def __init__(self, columns, index):
+        self.columns = columns
+        self.index = index
+
+    def __len__(self):
+        return len(self.index)
+
+    def take(self, positions):
+        """Gather rows at `positions` into a new pandas.DataFrame."""
+        data = {}
+        for name, column in self.columns.items():
+            values = column[positions]
+            if values.dtype.kind == 'S':
+                values = _decode_strings(values)
+            data[name] = values
+        return pd.DataFrame(data, columns=list(self.columns),
+                            index=self.index[positions])
+
+
+# EXIF columns of the popular table joined onto search results.
+exif_columns = ('Camera', 'ExposureTime', 'FNumber', 'FocalLength',
+                'FocalLengthIn35mmFormat', 'ISO', 'Lens')
+# Display strings of EXIF columns, which the popular table may have
+# precomputed (see `mapping.format_exif`).  Joined onto search results if
+# present.
+formatted_exif_columns = ('exif_camera', 'exif_lens', 'exif_flen',
+                          'exif_exptime', 'exif_fno', 'exif_iso')
+
+
+def _popular_columns(available):
+    """Names of popular table columns to join onto search results."""
+    return exif_columns + tuple(name for name in formatted_exif_columns
+                                if name in available)
+
+
+def _take_rows(table, positions):
+    if isinstance(table, ColumnStore):
+        return table.take(positions)
+    return table.iloc[positions].copy()
+
+
+# Stored in place of missing strings.  Not valid UTF-8, so no string encodes
+# to it.
+_missing_string = b'\xff'
+
+
+def _encode_strings(values):
+    """Encode string columns as fixed-width bytes that can be memory-mapped.
+
+    Missing values are stored as `_missing_string`.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind not in 'OU':
+        return values
+    missing = pd.isnull(values)
+    values = values.astype(object)
+    values[missing] = ''
+    encoded = np.char.encode(values.astype(str), 'utf-8')
+    encoded = encoded.astype('S{0}'.format(max(encoded.dtype.itemsize, 1)))
+    encoded[missing] = _missing_string
+    return encoded
+
+
+def _decode_strings(values):
+    """Inverse of `_encode_strings`, with missing values as NaN."""
+    missing = values == _missing_string
+    decoded = np.char.decode(values, 'utf-8', errors='replace').astype(object)
+    decoded[missing] = np.nan
+    return decoded
+
+
+def align_to_main_table(mtab_index, poptab_index):
+    """Map main table positions to popular table positions.
+
+    Returns
+    -------
+    mtab_to_poptab : numpy.ndarray
+        For each main table row, the position of the popular table row with
+        the same index label, or -1 if there isn't one.
+    """
+    mtab_positions = pd.Index(mtab_index).get_indexer(poptab_index)
+    in_mtab = mtab_positions >= 0
+    mtab_to_poptab = np.full(len(mtab_index), -1, dtype=np.int64)
+    mtab_to_poptab[mtab_positions[in_mtab]] = np.flatnonzero(in_mtab)
+    return mtab_to_poptab
+
+
+def _gather_aligned(column, rows):
+    """Equivalent of a left join of `column` onto `rows`.
+
+    Takes `column[rows]`, filling in NaN wherever `rows` is -1.
+    """
+    present = rows >= 0
+    values = column[rows[present]]
+    if values.dtype.kind == 'S':
+        values = _decode_strings(values)
+    if present.all():
+        return values
+    gathered = np.full(len(rows), np.nan,
+                       dtype=(object if values.dtype.kind in 'OU'
+                              else np.float64))
+    gathered[present] = values
+    return gathered
+
+
+def _bundle_path(search_bundle, name):
+    return os.path.join(search_bundle, name + '.npy')
+
+
+def _file_fingerprint(path):
+    """Size and modification time of a file, to tell when it's replaced."""
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def build_search_bundle(search_bundle, mtab, poptab, main_table=None,
+                        popular_table=None):
+    """Precompute search artifacts and write them to a bundle folder.
+
+    The bundle holds the tag vocabulary and tag index of the main table, its
+    coordinates, `shared_columns` and view statistics, and popular table EXIF
+    data with its alignment to the main table, as ``.npy`` files (plus a
+    small JSON file of scalars) so that `FlickrPhotosDatabase` can load or
+    memory-map them instead of rederiving them on startup.
+
+    Parameters
+    ----------
+    search_bundle : str
+        Bundle folder; created if it doesn't exist.
+    mtab : pandas.DataFrame
+        Main table, with a whitespace-delimited string `tags` column.
+    poptab : pandas.DataFrame
+        Popular table, with `exif_columns`.
+    main_table, popular_table : str, optional
+        HDF5 files `mtab` and `poptab` are saved in.  If given, the bundle
+        records their sizes and modification times, and
+        `FlickrPhotosDatabase` refuses to load it once they change.
+    """
+    if not os.path.isdir(search_bundle):
+        os.makedirs(search_bundle)
+
+    vocabulary, (mtab_tags,) = encode_tags(mtab['tags'])
+    tag_vocabulary = SortedVocabulary.from_strings(vocabulary)
+    tag_index = TagIndex(mtab_tags, tag_vocabulary)
+    arrays = {'tag_vocabulary': tag_vocabulary.tags,
+              'longlat': mtab[['longitude', 'latitude']].values.astype(
+                  np.float64),
+              'mtab_index': mtab.index.values,
+              'mtab_postings': tag_index.postings,
+              'mtab_posting_offsets': tag_index.posting_offsets,
+              'mtab_to_poptab': align_to_main_table(mtab.index, poptab.index)}
+    # Longitude and latitude are served from `longlat`.
+    for name in shared_columns:
+        if name not in ('longitude', 'latitude'):
+            arrays['mtab_column_' + name] = _encode_strings(mtab[name])
+    for name in _popular_columns(poptab):
+        arrays['poptab_exif_' + name] = _encode_strings(poptab[name])
+    for name, array in arrays.items():
+        np.save(_bundle_path(search_bundle, name), array)
+
+    stats = {'n_main': len(mtab),
+             'n_popular': len(poptab),
+             'sorted_vocabulary': True,
+             'mtab_75percentile_views': float(
+                 np.percentile(mtab['views'], 75)),
+             'source_tables': {
+                 name: _file_fingerprint(path)
+                 for name, path in (('main', main_table),
+                                    ('popular', popular_table))
+                 if path is not None}}
+    with open(os.path.join(search_bundle, 'stats.json'), 'w') as f:
+        json.dump(stats, f)
+
+
+def read_search_bundle(search_bundle, mmap_mode=None):
+    """Read a bundle written by `build_search_bundle`.
+
+    Parameters
+    ----------
+    search_bundle : str
+        Bundle folder.
+    mmap_mode : None or str, optional
+        Passed to `numpy.load`; use 'r' to memory-map the arrays rather than
+        read them into memory.
+
+    Returns
+    -------
+    arrays : dict
+        Bundle arrays, keyed by name.
+    stats : dict
+        Scalar statistics.
+    """
+    with open(os.path.join(search_bundle, 'stats.json')) as f:
+        stats = json.load(f)
+    arrays = {}
+    for filename in os.listdir(search_bundle):
+        name, ext = os.path.splitext(filename)
+        if ext == '.npy':
+            arrays[name] = np.load(os.path.join(search_bundle, filename),
+                                   mmap_mode=mmap_mode)
+    return arrays, stats
 
 
 class FlickrPhotosDatabase:
+    """Searchable Flickr photo tables.
 
-    def __init__(self, main_table, popular_table):
+    Only the main table is searched.  The EXIF columns of the popular table
+    (a subset of the main table's rows) are aligned to main table positions
+    on load, and gathered onto search results.
+
+    Parameters
+    ----------
+    main_table : str
+        Processed main table HDF5 file.
+    popular_table : str
+        Processed popular table HDF5 file.
+    search_bundle : str or None, optional
+        Folder written by `build_search_bundle`.  If given, tags, the tag
+        index, EXIF columns and view statistics are loaded from it rather than
+        derived from the tables, and `popular_table` isn't read.  Bundles
+        that don't match the tables raise a ValueError.  Default: `None`.
+    mmap : bool, optional
+        Memory-map the bundle's arrays instead of reading them, and back the
+        main table with the bundle's `shared_columns` rather than reading
+        `main_table`.  Processes that open the same bundle (eg. web workers)
+        then share one physical copy of the main table.  Default: `False`.
+    """
+
+    def __init__(self, main_table, popular_table, search_bundle=None,
+                 mmap=False):
+        if search_bundle is None:
+            self._derive_search_artifacts(main_table, popular_table)
+        else:
+            self._load_search_bundle(search_bundle, main_table,
+                                     popular_table, mmap)
+
+    def _derive_search_artifacts(self, main_table, popular_table):
         self.mtab = pd.read_hdf(main_table, 'table')
-        self.poptab = pd.read_hdf(popular_table, 'table')
-        ################## REMOVE FOR LATER????######################
-        self.mtab['tags'] = self.mtab['tags'].str.split()
-        self.poptab['tags'] = self.poptab['tags'].str.split()
-        #############################################################
+        poptab = pd.read_hdf(popular_table, 'table')
+
+        vocabulary, (mtab_tags,) = encode_tags(self.mtab['tags'])
+        self.tag_vocabulary = SortedVocabulary.from_strings(vocabulary)
+        # Only the index is kept; searches don't need each photo's tags.
+        self.mtab_tag_index = TagIndex(mtab_tags, self.tag_vocabulary)
+        self.mtab.drop(columns='tags', inplace=True)
+
+        self.mtab_to_poptab = align_to_main_table(self.mtab.index,
+                                                  poptab.index)
+        self.poptab_exif = {name: np.asarray(poptab[name])
+                            for name in _popular_columns(poptab)}
+        self.mtab_longlat = self.mtab[['longitude', 'latitude']].values
         self.mtab_75percentile_views = np.percentile(self.mtab['views'], 75)
 
-    @staticmethod
-    def search_tags(table, phrase):
-        phrase_reduced = re.sub('[^0-9A-z\s]', '', phrase.lower())
-        search_args_split = phrase_reduced.split()
-        search_args_joined = "".join(search_args_split)
-        return table['tags'].apply(_contains_all, args=(search_args_split,
-                                                        search_args_joined))
-
-    def get_single_table_search_results(self, phrase, table):
-        if table == 'popular':
-            ctab = self.poptab
+    def _load_search_bundle(self, search_bundle, main_table, popular_table,
+                            mmap):
+        arrays, stats = read_search_bundle(
+            search_bundle, mmap_mode=('r' if mmap else None))
+        if mmap:
+            columns = {'longitude': arrays['longlat'][:, 0],
+                       'latitude': arrays['longlat'][:, 1]}
+            columns.update((name, arrays['mtab_column_' + name])
+                           for name in shared_columns if name not in columns)
+            self.mtab = ColumnStore(columns, arrays['mtab_index'])
         else:
-            ctab = self.mtab
-        search_result_mask = self.search_tags(ctab, phrase)
-        return ctab[search_result_mask].copy()
+            self.mtab = pd.read_hdf(main_table, 'table')
+            self.mtab.drop(columns='tags', inplace=True)
+
+        # Tables rebuilt since the bundle was.  Unless memory-mapping, the
+        # main table has been read, so its photos can be compared directly.
+        sources = stats.get('source_tables', {})
+        stale = (
+            stats['n_main'] != len(self.mtab) or
+            (not mmap and not np.array_equal(arrays['mtab_index'],
+                                             self.mtab.index.values)) or
+            any(sources[name] != _file_fingerprint(path)
+                for name, path in (('main', main_table),
+                                   ('popular', popular_table))
+                if name in sources))
+        if stale:
+            raise ValueError("search bundle {0} does not match the main "
+                             "table; rebuild it.".format(search_bundle))
+        if (not stats.get('sorted_vocabulary') or
+                arrays['tag_vocabulary'].dtype.kind != 'S'):
+            raise ValueError("search bundle {0} predates sorted UTF-8 tag "
+                             "vocabularies; rebuild it.".format(search_bundle))
+
+        self.tag_vocabulary = SortedVocabulary(arrays['tag_vocabulary'])
+        self.mtab_tag_index = TagIndex.from_postings(
+            arrays['mtab_postings'], arrays['mtab_posting_offsets'],
+            self.tag_vocabulary, stats['n_main'])
+        self.mtab_to_poptab = arrays['mtab_to_poptab']
+        self.poptab_exif = {
+            name: arrays['poptab_exif_' + name]
+            for name in _popular_columns(
+                [name[len('poptab_exif_'):] for name in arrays])}
+        self.mtab_longlat = arrays['longlat']
+        self.mtab_75percentile_views = stats['mtab_75percentile_views']
+
+    def search_tags(self, phrase):
+        """Find photos whose tags match a search phrase.
+
+        A photo matches if its tags contain every word of the phrase, or
+        contain the phrase with its whitespace removed (eg. "cntower" for
+        "CN Tower").
+
+        Parameters
+        ----------
+        phrase : str
+            Search phrase.
+
+        Returns
+        -------
+        positions : numpy.ndarray
+            Sorted main table row positions of matching photos.
+        """
+        return self.mtab_tag_index.search(*_reduce_phrase(phrase))
+
+    def frequent_phrases(self, n_tags=100, n_pairs=100, n_candidates=200):
+        """Most common tags and tag pairs, as search phrases.
+
+        Parameters
+        ----------
+        n_tags : int, optional
+            Number of single tags to return.  Default: 100.
+        n_pairs : int, optional
+            Number of tag pairs to return.  Default: 100.
+        n_candidates : int, optional
+            Pairs are drawn from this many of the most common tags.  Default:
+            200.
+
+        Returns
+        -------
+        phrases : list of str
+            Single tags in descending order of frequency, then pairs of tags
+            ("tag1 tag2", with the more common tag first) in descending order
+            of how many photos have both.
+        """
+        tag_index = self.mtab_tag_index
+        counts = np.diff(tag_index.posting_offsets)
+        # Stable sort so ties are broken by tag ID, i.e. alphabetically.
+        by_count = np.argsort(-counts, kind='mergesort')
+        by_count = by_count[counts[by_count] > 0]
+        phrases = [self.tag_vocabulary[i] for i in by_count[:n_tags]]
+
+        # Count photos with both tags of every candidate pair at once, as the
+        # upper triangle of M.T M for the photo x candidate incidence matrix M.
+        candidates = by_count[:n_candidates]
+        rows = np.concatenate(
+            [tag_index.empty] +
+            [tag_index.postings[tag_index.posting_offsets[i]:
+                                tag_index.posting_offsets[i + 1]]
+             for i in candidates])
+        columns = np.repeat(np.arange(len(candidates)), counts[candidates])
+        incidence = csr_matrix(
+            (np.ones(len(rows), dtype=np.int64), (rows, columns)),
+            shape=(tag_index.n_rows, len(candidates)))
+        pair_counts = triu(incidence.T.dot(incidence), k=1).tocoo()
+        first, second, n_both = (pair_counts.row, pair_counts.col,
+                                 pair_counts.data)
+        # Order by descending count, then by candidate order.
+        order = np.lexsort((second, first, -n_both))
+        order = order[n_both[order] > 0][:n_pairs]
+        phrases += [self.tag_vocabulary[candidates[first[k]]] + ' ' +
+                    self.tag_vocabulary[candidates[second[k]]]
+                    for k in order]
+        return phrases
 
     def get_search_results(self, phrase):
-        main_results = self.get_single_table_search_results(phrase, 'main')
-        popular_results = self.get_single_table_search_results(phrase,
-                                                               'popular')
-
-        return main_results.join(
-            popular_results[['Camera', 'ExposureTime', 'FNumber',
-                             'FocalLength', 'FocalLengthIn35mmFormat',
-                             'ISO', 'Lens']])
+        return self.take_search_results(self.search_tags(phrase))
+
+    def take_search_results(self, positions):
+        """Gather the main table rows at `positions`, with EXIF columns."""
+        results = _take_rows(self.mtab, positions)
+        popular_rows = self.mtab_to_poptab[positions]
+        for name, column in self.poptab_exif.items():
+            results[name] = _gather_aligned(column, popular_rows)
+        return results
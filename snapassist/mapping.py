@@ -1,13 +1,28 @@
 import numpy as np
 import pandas as pd
 import operator
+import json
 import folium
 import branca
-from matplotlib import colors as mpl_colors
-from matplotlib import cm as mpl_cm
+from jinja2 import Template
 
+from . import database
 
-paired_cmap = mpl_cm.get_cmap('Paired')
+
+# Colours of matplotlib's 'Paired' colormap, cycled through by cluster label.
+cluster_colors = np.array(['#a6cee3', '#1f78b4', '#b2df8a', '#33a02c',
+                           '#fb9a99', '#e31a1c', '#fdbf6f', '#ff7f00',
+                           '#cab2d6', '#6a3d9a', '#ffff99', '#b15928'],
+                          dtype=object)
+# Colour of background (unclustered) photos.
+background_color = '#777777'
+
+
+def get_cluster_colors(labels):
+    """Colour of each of an array of cluster labels."""
+    labels = np.asarray(labels)
+    return np.where(labels < 0, background_color,
+                    cluster_colors[labels % len(cluster_colors)])
 
 
 def make_flickr_link(row):
@@ -27,16 +42,7 @@ def make_photo_popup(row, cluster_info):
 
 ##### Popup HTML (used in ClusterInfo, defined here for clarity) #####
 
-best_photo_html_head = r"""<!DOCTYPE html>
-<html lang="en">
-<head>
-  <title>Bootstrap Example</title>
-  <meta charset="utf-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css">
-  <script src="https://ajax.googleapis.com/ajax/libs/jquery/3.3.1/jquery.min.js"></script>
-  <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js"></script>
-<style>
+best_photo_css = r"""<style>
 .carel-container {
     width: 300px;
     height: 420px;   
@@ -69,7 +75,18 @@ best_photo_html_head = r"""<!DOCTYPE html>
 .carousel-indicators .active{
     background-color: #f00;
 }
-</style>
+</style>"""
+
+best_photo_html_head = r"""<!DOCTYPE html>
+<html lang="en">
+<head>
+  <title>Bootstrap Example</title>
+  <meta charset="utf-8">
+  <meta name="viewport" content="width=device-width, initial-scale=1">
+  <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/css/bootstrap.min.css">
+  <script src="https://ajax.googleapis.com/ajax/libs/jquery/3.3.1/jquery.min.js"></script>
+  <script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.7/js/bootstrap.min.js"></script>
+""" + best_photo_css + r"""
 </head>
 <body>
 """
@@ -78,15 +95,15 @@ best_photo_html_tail = r"""<h3>Cluster #{rank}</h3>
 Lat-Long: ({lat}, {long})<br>
 Number of photos: {n_photos}<br>
 Avg. views per photo: {avg_views}<br><br>
-<div id="myCarousel" class="carousel slide" data-ride="carousel" data-interval=false>
+<div id="{carousel_id}" class="carousel slide" data-ride="carousel" data-interval=false>
  <div class="carousel-inner">
 {carousel_elements}
  </div>
- <a class="left carousel-control" href="#myCarousel" data-slide="prev" style="background:none">
+ <a class="left carousel-control" href="#{carousel_id}" data-slide="prev" style="background:none">
    <span class="glyphicon glyphicon-chevron-left"></span>
    <span class="sr-only">Previous</span>
  </a>
- <a class="right carousel-control" href="#myCarousel" data-slide="next" style="background:none">
+ <a class="right carousel-control" href="#{carousel_id}" data-slide="next" style="background:none">
    <span class="glyphicon glyphicon-chevron-right"></span>
    <span class="sr-only">Next</span>
  </a>
@@ -115,13 +132,86 @@ best_photo_html_element = r"""  <div class="item{active} carel-container">
 ##### Popup HTML (used in ClusterInfo, defined here for clarity) #####
 
 
+def _format_model(values):
+    # Camera or lens name, or '' if it's missing.
+    values = np.asarray(values, dtype=object)
+    return np.where(pd.notnull(values) & (values != "N/A"), values, '')
+
+
+def _format_positive(values, formatter):
+    # Vectorized `formatter` of the positive values, and '' for the rest
+    # (including NaN).
+    values = np.asarray(values, dtype=np.float64)
+    formatted = np.full(len(values), '', dtype=object)
+    positive = values > 0
+    formatted[positive] = formatter(values[positive])
+    return formatted
+
+
+def _format_focal_length(focal_length):
+    return np.char.add(focal_length.astype(np.int64).astype(str), ' mm')
+
+
+def _format_exposure_time(exptime):
+    formatted = np.empty(len(exptime), dtype=object)
+    long_exposure = exptime >= 1
+    formatted[long_exposure] = np.char.add(
+        exptime[long_exposure].astype(np.int64).astype(str), ' s')
+    formatted[~long_exposure] = np.char.add(np.char.add(
+        '1/', (1. / exptime[~long_exposure]).astype(np.int64).astype(str)),
+        ' s')
+    return formatted
+
+
+def format_exif(table):
+    """Display strings of photos' EXIF data.
+
+    Missing or invalid (non-positive) values are displayed as ''.
+
+    Parameters
+    ----------
+    table : pandas.DataFrame
+        Photos, with `database.exif_columns`.
+
+    Returns
+    -------
+    formatted : pandas.DataFrame
+        `database.formatted_exif_columns` of each photo, with the index of
+        `table`.
+    """
+    formatted = {
+        'exif_camera': _format_model(table['Camera'].values),
+        'exif_lens': _format_model(table['Lens'].values),
+        'exif_flen': _format_positive(table['FocalLength'].values,
+                                      _format_focal_length),
+        'exif_exptime': _format_positive(table['ExposureTime'].values,
+                                         _format_exposure_time),
+        'exif_fno': _format_positive(table['FNumber'].values,
+                                     lambda fno: np.char.mod('f/%.1f', fno)),
+        'exif_iso': _format_positive(
+            table['ISO'].values,
+            lambda iso: np.char.mod('%d', iso.astype(np.int64)))}
+    return pd.DataFrame(formatted, index=table.index,
+                        columns=list(database.formatted_exif_columns))
+
+
 class Cluster:
+    """Summary of one cluster.
 
-    def __init__(self, n_photos, centroid, avg_views, best_photos):
+    The best photos are stored as positions in the search results table, and
+    only looked up when the popup is rendered.
+    """
+
+    def __init__(self, n_photos, centroid, avg_views, best_rows, table):
         self.n_photos = operator.index(n_photos)
         self.centroid = centroid
         self.avg_views = avg_views
-        self.best_photos = pd.DataFrame(best_photos)
+        self.best_rows = best_rows
+        self.table = table
+
+    @property
+    def best_photos(self):
+        return self.table.iloc[self.best_rows]
 
 
 class ClusterInfo:
@@ -135,8 +225,12 @@ class ClusterInfo:
     # Currently hardcoded in CSS, so hardcode it here.
     popup_width = 300
 
+    # Number of photos shown in each cluster's popup.
+    n_best_photos = 5
+
     def __init__(self, table, ids, centroids):
         self.table = table
+        self._best_photo_records = None
 
         # Populate clusters.
         self.populate_clusters(ids, centroids)
@@ -144,122 +238,162 @@ class ClusterInfo:
         # Sort clusters and store their rank.  (We use nphot_over_views
         # because np.argsort(np.argsort(nphot_over_views)) + 1 is equivalent to
         # ranking views_over_nphot)
-        nphot_over_views = [c.n_photos / c.avg_views
-                            for key, c in self.clusters.items()]
-        cluster_order = list(np.argsort(np.argsort(nphot_over_views)) + 1)
+        nphot_over_views = self.n_photos / self.avg_views
+        cluster_order = np.argsort(np.argsort(nphot_over_views)) + 1
         for i, (key, cluster) in enumerate(self.clusters.items()):
             cluster.rank = cluster_order[i]
 
     def populate_clusters(self, ids, centroids):
+        """Count, median views and most viewed photos of each cluster.
+
+        Rows are sorted once by cluster, then by descending views (stably, so
+        photos with equal views stay in table order), which puts each
+        cluster's best photos at the start of its segment of the sort.
+        """
+        labels = self.table['cluster'].values
+        views = self.table['views'].values
+        order = np.lexsort((-views, labels))
+        sorted_views = views[order]
+        sorted_labels = labels[order]
+        starts = np.searchsorted(sorted_labels, ids, side='left')
+        ends = np.searchsorted(sorted_labels, ids, side='right')
+
+        ############## TO DO: Mean or median??? ##################
+        self.n_photos = ends - starts
+        # Median from the middle one or two views of each sorted segment.
+        self.avg_views = 0.5 * (
+            sorted_views[starts + (self.n_photos - 1) // 2] +
+            sorted_views[starts + self.n_photos // 2])
+
         self.clusters = {}
         for i in range(len(ids)):
-            c_cluster = self.table[self.table['cluster'] == ids[i]]
-            c_n_photos = c_cluster.shape[0]
-            c_n_centroid = centroids[i]
-            ############## TO DO: Mean or median??? ##################
-            # c_n_avg_views = c_cluster['views'].sum() / c_n_photos
-            c_n_avg_views = c_cluster['views'].median()
-            c_n_best_photos = c_cluster.sort_values(
-                'views', ascending=False).iloc[:5, :]
+            best_rows = order[starts[i]:min(ends[i],
+                                            starts[i] + self.n_best_photos)]
             self.clusters[ids[i]] = (
-                Cluster(c_n_photos, c_n_centroid, c_n_avg_views,
-                        c_n_best_photos))
+                Cluster(self.n_photos[i], centroids[i], self.avg_views[i],
+                        best_rows, self.table))
 
     @staticmethod
     def get_cluster_color(cluster_number):
         if cluster_number < 0:
-            return '#777777'
-        else:
-            return mpl_colors.rgb2hex(
-                paired_cmap((cluster_number % 12) / 12.)[:3])
+            return background_color
+        return cluster_colors[cluster_number % len(cluster_colors)]
 
-    @staticmethod
-    def get_camera_or_lens(model):
-        if isinstance(model, str):
-            if model == "N/A":
-                return ''
-            return model
-        return ''
-
-    @staticmethod
-    def get_focal_length(focal_length):
-        if focal_length > 0:
-            focal_length = "{} mm".format(str(int(focal_length)))
-            # if focal_length_35mm > 0:
-            #     focal_length_35mm = str(int(focal_length_35mm))
-            #     focal_length += " ({} mm at 35mm eqv)".format(
-            #         focal_length_35mm)
-        else:
-            focal_length = ''
-        return focal_length
-
-    @staticmethod
-    def get_exposure_time(exptime):
-        if exptime > 0:
-            if exptime >= 1:
-                return str(int(exptime)) + " s"
-            exptime = str(int(1. / exptime))
-            return "1/{} s".format(exptime)
-        return ''
-
-    @staticmethod
-    def get_fnumber(fnumber):
-        if fnumber > 0:
-            return "f/{0:.1f}".format(fnumber)
-        return ''
-
-    @staticmethod
-    def get_iso(iso):
-        if iso > 0:
-            return "{0:d}".format(int(iso))
-        return ''
-
-    def scale_image_to_frame(self, width, height):
-        """Scale Flickr url_s image to fit Folium popup.
+    def scale_images_to_frame(self, widths, heights):
+        """Scale Flickr url_s images to fit Folium popup.
 
         Popup shape is hard-coded as `self.popup_width` in both length and
-        height.  Function rescales so that the long axis exactly fits within
-        this box.
+        height.  Function rescales so that the long axis of each image exactly
+        fits within this box.
+
+        Parameters
+        ----------
+        widths, heights : numpy.ndarray
+            Image sizes.
+
+        Returns
+        -------
+        imgwidths, imgheights : numpy.ndarray
+            Scaled image sizes.
+        """
+        widths = np.asarray(widths, dtype=np.float64)
+        heights = np.asarray(heights, dtype=np.float64)
+        # Scale landscape images by width, and portrait ones by height.
+        landscape = widths / heights >= 1
+        scale = self.popup_width / np.where(landscape, widths, heights)
+        imgwidths = np.where(landscape, self.popup_width,
+                             (scale * widths).astype(np.int64))
+        imgheights = np.where(landscape, (scale * heights).astype(np.int64),
+                              self.popup_width)
+        return imgwidths, imgheights
+
+    def get_photo_records(self, photos):
+        """Display values of photos, for `best_photo_html_element`.
+
+        EXIF display strings are taken from `database.formatted_exif_columns`
+        if `photos` has them, and formatted with `format_exif` otherwise.
+
+        Parameters
+        ----------
+        photos : pandas.DataFrame
+            Rows of search results.
+
+        Returns
+        -------
+        records : list of dict
+            Display values of each photo.
         """
-        aspect = width / height
-        # Image is landscape.
-        if aspect >= 1:
-            scale = self.popup_width / width
-            return (self.popup_width, int(scale * height))
-        # Otherwise image is portrait.
-        scale = self.popup_width / height
-        return (int(scale * width), self.popup_width)
-
-    def get_carousel(self, row, first=False):
-        imgwidth, imgheight = self.scale_image_to_frame(row['width_s'],
-                                                        row['height_s'])
+        if all(name in photos for name in database.formatted_exif_columns):
+            # Photos not in the popular table have no EXIF data.
+            exif = photos[list(database.formatted_exif_columns)].fillna('')
+        else:
+            exif = format_exif(photos)
+        imgwidths, imgheights = self.scale_images_to_frame(
+            photos['width_s'].values, photos['height_s'].values)
+        columns = {
+            'pic_url_s': photos['url_s'].values.tolist(),
+            'imgwidth': imgwidths.tolist(),
+            'imgheight': imgheights.tolist(),
+            'link': [make_flickr_link({'owner': owner, 'id': photoid})
+                     for owner, photoid in zip(photos['owner'].values,
+                                               photos['id'].values)]}
+        for name in database.formatted_exif_columns:
+            columns[name[len('exif_'):]] = exif[name].values.tolist()
+        return [dict(zip(columns, values)) for values in
+                zip(*columns.values())]
+
+    def get_best_photo_records(self):
+        """Display values of the best photos of every cluster.
+
+        Formats all clusters' best photos in one pass, and caches them.
+
+        Returns
+        -------
+        records : dict
+            For each cluster ID, a list of the display values of its best
+            photos (see `get_photo_records`).
+        """
+        if self._best_photo_records is None:
+            ids = list(self.clusters.keys())
+            best_rows = [self.clusters[i].best_rows for i in ids]
+            records = self.get_photo_records(
+                self.table.iloc[np.concatenate(best_rows)
+                                if best_rows else []])
+            bounds = np.cumsum([0] + [len(rows) for rows in best_rows])
+            self._best_photo_records = {
+                i: records[bounds[j]:bounds[j + 1]]
+                for j, i in enumerate(ids)}
+        return self._best_photo_records
+
+    def get_carousel(self, record, first=False):
         if first:
             active = " active"
         else:
             active = ""
         return best_photo_html_element.format(
-            pic_url_s=row['url_s'],
-            active=active,
-            boxl=self.popup_width,
-            imgwidth=imgwidth,
-            imgheight=imgheight,
-            link=make_flickr_link(row),
-            camera=self.get_camera_or_lens(row['Camera']),
-            lens=self.get_camera_or_lens(row['Lens']),
-            flen=self.get_focal_length(row['FocalLength']),
-            exptime=self.get_exposure_time(row['FocalLength']),
-            fno=self.get_fnumber(row['FNumber']),
-            iso=self.get_iso(row['ISO']))
+            active=active, boxl=self.popup_width, **record)
+
+    def get_cluster_record(self, i):
+        """Display values of cluster `i`, for `best_photo_html_tail`, with
+        those of its best photos under 'photos'."""
+        cluster = self.clusters[i]
+        return {'rank': int(cluster.rank),
+                'long': "{0:.7f}".format(cluster.centroid[0]),
+                'lat': "{0:.7f}".format(cluster.centroid[1]),
+                'n_photos': cluster.n_photos,
+                'avg_views': int(cluster.avg_views),
+                'photos': self.get_best_photo_records()[i]}
 
     def get_cluster_infographic(self, i):
         cluster = self.clusters[i]
 
         carousel_elements = ""
-        for ib, (ind, row) in enumerate(cluster.best_photos.iterrows()):
+        for ib, record in enumerate(self.get_best_photo_records()[i]):
             if ib == 0:
-                carousel_elements += self.get_carousel(row, first=True) + "\n"
+                carousel_elements += self.get_carousel(record,
+                                                       first=True) + "\n"
             else:
-                carousel_elements += self.get_carousel(row) + "\n"
+                carousel_elements += self.get_carousel(record) + "\n"
 
         popup_html = best_photo_html_tail.format(
             rank=cluster.rank,
@@ -267,12 +401,459 @@ class ClusterInfo:
             lat="{0:.7f}".format(cluster.centroid[1]),
             n_photos=cluster.n_photos,
             avg_views=int(cluster.avg_views),
+            carousel_id="myCarousel",
             carousel_elements=carousel_elements)
 
         return cluster.centroid, best_photo_html_head + '\n' + popup_html
 
 
-def make_map(results, cluster_info, default_longlat):
+class ClusterPopupLayer(branca.element.MacroElement):
+    """Markers at cluster centroids, with popups rendered client-side.
+
+    Each cluster is embedded as a JSON record (see
+    `ClusterInfo.get_cluster_record`), and its popup is only rendered, from
+    `best_photo_html_tail` and `best_photo_html_element`, when its marker is
+    clicked.  The popup CSS is included once in the page, and the carousel
+    uses the Bootstrap scripts already loaded by the map, so popups need no
+    IFrames.
+
+    Parameters
+    ----------
+    cluster_info : ClusterInfo
+        Cluster information of the search results.
+    """
+
+    _template = Template(u"""
+{% macro header(this, kwargs) %}
+    {{ this.css }}
+{% endmacro %}
+
+{% macro script(this, kwargs) %}
+    (function () {
+        var map = {{ this._parent.get_name() }};
+        var config = {{ this.config }};
+        function fill(template, values) {
+            return template.replace(/\\{(\\w+)\\}/g, function (match, name) {
+                return values[name];
+            });
+        }
+        function makePopup(record) {
+            var elements = '';
+            for (var i = 0; i < record.photos.length; i++) {
+                var photo = L.extend(
+                    {active: (i === 0 ? ' active' : '')}, record.photos[i]);
+                elements += fill(config.element, photo) + '\\n';
+            }
+            return fill(config.tail, L.extend(
+                {carousel_id: 'carousel-' + record.rank,
+                 carousel_elements: elements}, record));
+        }
+        function bindPopup(marker, record) {
+            marker.bindPopup(function () { return makePopup(record); },
+                             {maxWidth: config.popup_width,
+                              minWidth: config.popup_width});
+        }
+        for (var i = 0; i < config.records.length; i++) {
+            var record = config.records[i];
+            var marker = L.marker([record.lat, record.long]);
+            bindPopup(marker, record);
+            marker.addTo(map);
+        }
+    })();
+{% endmacro %}
+""")
+
+    css = best_photo_css
+
+    def __init__(self, cluster_info):
+        super().__init__()
+        self._name = 'ClusterPopupLayer'
+        self.config = _script_json({
+            'records': [cluster_info.get_cluster_record(i)
+                        for i in cluster_info.clusters.keys()],
+            'tail': best_photo_html_tail,
+            'element': best_photo_html_element,
+            'popup_width': cluster_info.popup_width})
+
+
+# Jinja macro of the JavaScript `makePhotoPopup(data, i, ranks)`, which
+# builds the popup HTML of photo `i` of a columnar `data` payload (as
+# `make_photo_popup` does), given the cluster ranks of `_cluster_style`.
+# Included in the templates of the point layers below.
+_photo_popup_macro = u"""
+{% macro photo_popup_script() %}
+        function makePhotoPopup(data, i, ranks) {
+            var label = data.cluster[i];
+            var rank = (label >= 0 ? ranks[label] : 'background');
+            return ('Cluster ' + rank + '<br><a href="' +
+                    'https://www.flickr.com/photos/' + data.owner[i] + '/' +
+                    data.id[i] + '" target="_blank"><img border="0" src="' +
+                    data.url_s[i] + '"></a>');
+        }
+{%- endmacro %}
+"""
+
+
+class PhotoPointLayer(branca.element.MacroElement):
+    """All search results as one canvas-rendered Leaflet layer.
+
+    Rather than a `folium.CircleMarker` (each with its own popup HTML) per
+    photo, the points are embedded as a single compact JSON payload of
+    columns.  Marker colours are looked up client-side from the cluster
+    label, and photo popups are only built when a marker is clicked.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        Clustered search results.
+    cluster_info : ClusterInfo
+        Cluster information of `results`.
+    """
+
+    _template = Template(_photo_popup_macro + u"""
+{% macro script(this, kwargs) %}
+    (function () {
+        var data = {{ this.data }};
+        var renderer = L.canvas();
+        var layer = L.layerGroup();
+{{- photo_popup_script() }}
+        function bindPopup(marker, i) {
+            marker.bindPopup(function () {
+                return makePhotoPopup(data, i, data.ranks);
+            });
+        }
+        for (var i = 0; i < data.latitude.length; i++) {
+            var label = data.cluster[i];
+            var color = (label < 0 ? data.background_color :
+                         data.colors[label % data.colors.length]);
+            var marker = L.circleMarker(
+                [data.latitude[i], data.longitude[i]],
+                {renderer: renderer, radius: (label < 0 ? 1 : 2),
+                 color: color, fillColor: color});
+            bindPopup(marker, i);
+            layer.addLayer(marker);
+        }
+        layer.addTo({{ this._parent.get_name() }});
+    })();
+{% endmacro %}
+""")
+
+    # Decimal places kept for long/lat (about 0.1 m).
+    decimals = 6
+
+    def __init__(self, results, cluster_info):
+        super().__init__()
+        self._name = 'PhotoPointLayer'
+        labels = results['cluster'].values
+        data = {
+            'latitude': np.round(results['latitude'].values,
+                                 self.decimals).tolist(),
+            'longitude': np.round(results['longitude'].values,
+                                  self.decimals).tolist(),
+            'cluster': labels.tolist(),
+            'id': results['id'].values.tolist(),
+            'owner': results['owner'].values.tolist(),
+            'url_s': results['url_s'].values.tolist()}
+        data.update(_cluster_style(cluster_info))
+        self.data = _script_json(data)
+
+
+class LODPointLayer(branca.element.MacroElement):
+    """Level-of-detail aggregates of search results, fetched as the map moves.
+
+    Whenever the map is panned or zoomed, the aggregates of photos in view at
+    the current zoom are requested from `url` (see `tiling.PointHierarchy`
+    and the webapp's `/points` endpoint), and redrawn.  Aggregates are drawn
+    with a radius growing with their number of photos, and zoom the map in
+    when clicked.  Single photos are drawn as in `PhotoPointLayer`.
+
+    Parameters
+    ----------
+    url : str
+        URL of the search results' `/points` endpoint.
+    cluster_info : ClusterInfo
+        Cluster information of the search results.
+    """
+
+    _template = Template(_photo_popup_macro + u"""
+{% macro script(this, kwargs) %}
+    (function () {
+        var map = {{ this._parent.get_name() }};
+        var config = {{ this.config }};
+        var renderer = L.canvas();
+        var layer = L.layerGroup().addTo(map);
+        var request = null;
+{{- photo_popup_script() }}
+        function addPoint(data, i) {
+            var label = data.cluster[i];
+            var count = data.count[i];
+            var color = (label < 0 ? config.background_color :
+                         config.colors[label % config.colors.length]);
+            var latlng = [data.latitude[i], data.longitude[i]];
+            var radius = (count > 1 ? 3 + 2 * Math.log(count) :
+                          (label < 0 ? 1 : 2));
+            var marker = L.circleMarker(
+                latlng, {renderer: renderer, radius: radius, color: color,
+                         fillColor: color});
+            if (count > 1) {
+                marker.bindTooltip(count + ' photos');
+                marker.on('click', function () {
+                    map.setView(latlng, map.getZoom() + 2);
+                });
+            } else {
+                marker.bindPopup(function () {
+                    return makePhotoPopup(data, i, config.ranks);
+                });
+            }
+            layer.addLayer(marker);
+        }
+        function update() {
+            var bounds = map.getBounds();
+            var bbox = [bounds.getWest(), bounds.getSouth(),
+                        bounds.getEast(), bounds.getNorth()].join(',');
+            if (request !== null) {
+                request.abort();
+            }
+            request = new XMLHttpRequest();
+            request.open('GET', config.url + '?z=' + map.getZoom() +
+                         '&bbox=' + bbox);
+            request.responseType = 'json';
+            request.onload = function () {
+                if (this.status !== 200) {
+                    return;
+                }
+                var data = this.response;
+                layer.clearLayers();
+                for (var i = 0; i < data.count.length; i++) {
+                    addPoint(data, i);
+                }
+            };
+            request.send();
+        }
+        map.on('moveend', update);
+        update();
+    })();
+{% endmacro %}
+""")
+
+    def __init__(self, url, cluster_info):
+        super().__init__()
+        self._name = 'LODPointLayer'
+        config = {'url': url}
+        config.update(_cluster_style(cluster_info))
+        self.config = _script_json(config)
+
+
+class TilePointLayer(branca.element.MacroElement):
+    """Level-of-detail aggregates of search results, drawn from binary tiles.
+
+    A Leaflet grid layer that fetches each visible map tile's aggregates
+    from the webapp's `/tiles` endpoint (encoded with `tiling.encode_tile`)
+    and draws them on a canvas, as `LODPointLayer` would.  Only tiles in view
+    are fetched, and each can be cached by the browser.  Clicking an
+    aggregate zooms the map in, and clicking a single photo fetches its popup
+    fields from `/points`.
+
+    Parameters
+    ----------
+    tiles_url : str
+        URL template of the search results' tiles, with `{z}`, `{x}` and `{y}`
+        placeholders.
+    points_url : str
+        URL of the search results' `/points` endpoint.
+    cluster_info : ClusterInfo
+        Cluster information of the search results.
+    """
+
+    _template = Template(_photo_popup_macro + u"""
+{% macro script(this, kwargs) %}
+    (function () {
+        var map = {{ this._parent.get_name() }};
+        var config = {{ this.config }};
+        var tiles = {};
+{{- photo_popup_script() }}
+        function tileKey(coords) {
+            return coords.z + '/' + coords.x + '/' + coords.y;
+        }
+        function decode(buffer) {
+            var n = new Uint32Array(buffer, 0, 1)[0];
+            return {count: new Uint32Array(buffer, 4, n),
+                    cluster: new Int32Array(buffer, 4 + 4 * n, n),
+                    row: new Uint32Array(buffer, 4 + 8 * n, n),
+                    x: new Int16Array(buffer, 4 + 12 * n, n),
+                    y: new Int16Array(buffer, 4 + 14 * n, n)};
+        }
+        function colorOf(label) {
+            return (label < 0 ? config.background_color :
+                    config.colors[label % config.colors.length]);
+        }
+        function radiusOf(count, label) {
+            return (count > 1 ? 3 + 2 * Math.log(count) :
+                    (label < 0 ? 1 : 2));
+        }
+        function draw(canvas, points) {
+            var context = canvas.getContext('2d');
+            var scale = canvas.width / config.extent;
+            context.lineWidth = 3;
+            for (var i = 0; i < points.count.length; i++) {
+                context.beginPath();
+                context.arc(points.x[i] * scale, points.y[i] * scale,
+                            radiusOf(points.count[i], points.cluster[i]),
+                            0, 2 * Math.PI);
+                context.fillStyle = context.strokeStyle = colorOf(
+                    points.cluster[i]);
+                context.globalAlpha = 0.2;
+                context.fill();
+                context.globalAlpha = 1;
+                context.stroke();
+            }
+        }
+        var Layer = L.GridLayer.extend({
+            createTile: function (coords, done) {
+                var canvas = document.createElement('canvas');
+                var size = this.getTileSize();
+                canvas.width = size.x;
+                canvas.height = size.y;
+                var request = new XMLHttpRequest();
+                request.open('GET', config.tiles_url.replace(
+                    '{z}', coords.z).replace('{x}', coords.x).replace(
+                    '{y}', coords.y));
+                request.responseType = 'arraybuffer';
+                request.onload = function () {
+                    if (this.status === 200) {
+                        tiles[tileKey(coords)] = decode(this.response);
+                        draw(canvas, tiles[tileKey(coords)]);
+                    }
+                    done(null, canvas);
+                };
+                request.onerror = function () {
+                    done(new Error('Tile request failed.'), canvas);
+                };
+                request.send();
+                return canvas;
+            }
+        });
+        var layer = new Layer({noWrap: true});
+        layer.on('tileunload', function (e) {
+            delete tiles[tileKey(e.coords)];
+        });
+        layer.addTo(map);
+
+        function showPopup(latlng) {
+            // Fetch the photos within a pixel of the clicked one.
+            var zoom = map.getZoom();
+            var point = map.project(latlng, zoom);
+            var sw = map.unproject(point.add([-1, 1]), zoom);
+            var ne = map.unproject(point.add([1, -1]), zoom);
+            var request = new XMLHttpRequest();
+            request.open('GET', config.points_url + '?z=32&bbox=' +
+                         [sw.lng, sw.lat, ne.lng, ne.lat].join(','));
+            request.responseType = 'json';
+            request.onload = function () {
+                var data = this.response;
+                if (this.status !== 200 || !data.count.length) {
+                    return;
+                }
+                L.popup().setLatLng(latlng).setContent(
+                    makePhotoPopup(data, 0, config.ranks)).openOn(map);
+            };
+            request.send();
+        }
+        map.on('click', function (e) {
+            var zoom = map.getZoom();
+            var size = layer.getTileSize();
+            var point = map.project(e.latlng, zoom);
+            var coords = {z: zoom, x: Math.floor(point.x / size.x),
+                          y: Math.floor(point.y / size.y)};
+            var points = tiles[tileKey(coords)];
+            if (points === undefined) {
+                return;
+            }
+            // Find the clicked marker, if any.
+            var scale = size.x / config.extent;
+            var best = -1;
+            var bestDistance = Infinity;
+            for (var i = 0; i < points.count.length; i++) {
+                var dx = coords.x * size.x + points.x[i] * scale - point.x;
+                var dy = coords.y * size.y + points.y[i] * scale - point.y;
+                var distance = Math.sqrt(dx * dx + dy * dy);
+                if (distance < bestDistance && distance <= radiusOf(
+                        points.count[i], points.cluster[i]) + 3) {
+                    best = i;
+                    bestDistance = distance;
+                }
+            }
+            if (best < 0) {
+                return;
+            }
+            var latlng = map.unproject(
+                [coords.x * size.x + points.x[best] * scale,
+                 coords.y * size.y + points.y[best] * scale], zoom);
+            if (points.count[best] > 1) {
+                map.setView(latlng, zoom + 2);
+            } else {
+                showPopup(latlng);
+            }
+        });
+    })();
+{% endmacro %}
+""")
+
+    # Tile width, in tile coordinates (see `tiling.PointHierarchy.get_tile`).
+    extent = 4096
+
+    def __init__(self, tiles_url, points_url, cluster_info):
+        super().__init__()
+        self._name = 'TilePointLayer'
+        config = {'tiles_url': tiles_url, 'points_url': points_url,
+                  'extent': self.extent}
+        config.update(_cluster_style(cluster_info))
+        self.config = _script_json(config)
+
+
+def _cluster_style(cluster_info):
+    # Cluster ranks and colour palette, for drawing photos client-side.
+    return {'ranks': {str(key): int(cluster.rank)
+                      for key, cluster in cluster_info.clusters.items()},
+            'colors': cluster_colors.tolist(),
+            'background_color': background_color}
+
+
+def _script_json(data):
+    # Escape "</" so the JSON can't close the enclosing script tag.
+    return json.dumps(data, separators=(',', ':')).replace('</', '<\\/')
+
+
+def make_map(results, cluster_info, default_longlat, points='layer',
+             points_url=None, tiles_url=None):
+    """Folium map of clustered search results.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        Clustered search results.
+    cluster_info : ClusterInfo
+        Cluster information of `results`.
+    default_longlat : database.TorontoLongLat
+        Long/lat the map is centred on.
+    points : 'layer', 'lod', 'tiles' or 'markers', optional
+        How photos are drawn.  If 'layer' (default), all photos are embedded
+        as one `PhotoPointLayer`.  If 'lod', only the aggregates in view are
+        fetched from `points_url` by a `LODPointLayer`.  If 'tiles', they
+        are fetched as binary tiles from `tiles_url` by a `TilePointLayer`.
+        If 'markers', each photo is a `folium.CircleMarker` with its own
+        popup, which is much slower and heavier for large results.
+    points_url : str, optional
+        URL of the `/points` endpoint for `results`.  Required if `points`
+        is 'lod' or 'tiles'.
+    tiles_url : str, optional
+        URL template of the `/tiles` endpoint for `results`, with `{z}`,
+        `{x}` and `{y}` placeholders.  Required if `points` is 'tiles'.
+
+    Returns
+    -------
+    map_TO : folium.Map
+    """
 
     map_TO = folium.Map(location=(default_longlat.latitude,
                                   default_longlat.longitude),
@@ -280,22 +861,26 @@ def make_map(results, cluster_info, default_longlat):
                         tiles='cartodbpositron',
                         width='100%', height='100%')
 
-    results['color'] = [cluster_info.get_cluster_color(item)
-                        for item in results['cluster'].values]
-    for (ind, row) in results.iterrows():
-        folium.CircleMarker((row['latitude'], row['longitude']),
-                            popup=make_photo_popup(row, cluster_info),
-                            radius=(1 if row['cluster'] < 0 else 2),
-                            color=row['color'],
-                            fill_color=row['color']).add_to(map_TO)
+    if points == 'layer':
+        map_TO.add_child(PhotoPointLayer(results, cluster_info))
+    elif points == 'lod':
+        map_TO.add_child(LODPointLayer(points_url, cluster_info))
+    elif points == 'tiles':
+        map_TO.add_child(TilePointLayer(tiles_url, points_url, cluster_info))
+    elif points == 'markers':
+        results['color'] = get_cluster_colors(results['cluster'].values)
+        for (ind, row) in results.iterrows():
+            folium.CircleMarker((row['latitude'], row['longitude']),
+                                popup=make_photo_popup(row, cluster_info),
+                                radius=(1 if row['cluster'] < 0 else 2),
+                                color=row['color'],
+                                fill_color=row['color']).add_to(map_TO)
+    else:
+        raise ValueError(
+            "points must be 'layer', 'lod', 'tiles' or 'markers'.")
 
     # Plot best photo in each cluster.
-    for i in cluster_info.clusters.keys():
-        centroid, popup_html = cluster_info.get_cluster_infographic(i)
-        iframe = branca.element.IFrame(html=popup_html, width=300, height=560)
-        popup = folium.Popup(iframe, max_width=300)
-        folium.map.Marker(centroid[::-1], popup=popup,
-                          icon=None).add_to(map_TO)
+    map_TO.add_child(ClusterPopupLayer(cluster_info))
 
     return map_TO
 
@@ -316,8 +901,7 @@ def make_map_basic(results, results_background, cluster_info, default_longlat):
                             fill_color="#aaa").add_to(map_TO)
 
     # Plot clusters.
-    results['color'] = [cluster_info.get_cluster_color(item)
-                        for item in results['cluster'].values]
+    results['color'] = get_cluster_colors(results['cluster'].values)
     for (ind, row) in results.iterrows():
         popup_html = ('Cluster {cluster}: <a href="{link}"'
                       'target="_blank">{title}</a>').format(
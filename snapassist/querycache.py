@@ -0,0 +1,98 @@
+import collections
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+def sizeof(value):
+    """Approximate memory footprint of a cached value, in bytes."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(sizeof(item) for item in value)
+    if hasattr(value, 'nbytes'):
+        return int(value.nbytes)
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """Thread-safe LRU cache with a memory cap and optional time-to-live.
+
+    Entries are evicted least recently used first whenever the cache exceeds
+    `max_entries` entries or `max_bytes` bytes (as estimated by `sizeof`).
+    Values larger than `max_bytes` are never stored.
+
+    Parameters
+    ----------
+    max_entries : int or None, optional
+        Maximum number of entries.  Default: `None` (no limit).
+    max_bytes : int or None, optional
+        Maximum total size of stored values.  Default: `None` (no limit).
+    ttl : float or None, optional
+        Seconds after which an entry expires.  Default: `None` (never).
+    """
+
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Return the value cached under `key`, or `default` on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and (
+                    time.monotonic() > entry[2]):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        """Cache `value` under `key`, evicting old entries if necessary."""
+        nbytes = sizeof(value)
+        if self.max_bytes is not None and nbytes > self.max_bytes:
+            return
+        expiry = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, nbytes, expiry)
+            self.nbytes += nbytes
+            while ((self.max_entries is not None and
+                    len(self._entries) > self.max_entries) or
+                   (self.max_bytes is not None and
+                    self.nbytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Hit/miss counters and current size."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+    def _remove(self, key):
+        value, nbytes, expiry = self._entries.pop(key)
+        self.nbytes -= nbytes
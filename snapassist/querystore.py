@@ -0,0 +1,106 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+
+class QueryStore:
+    """On-disk store of arrays computed for search queries.
+
+    Each query's arrays are saved as one ``.npz`` file in `folder`, named by
+    a hash of the query key (eg. a canonical search phrase).  If the store
+    has a size budget, the least recently used files are deleted when a save
+    takes it over budget.  Files are marked as used by setting their
+    modification time, so the store can be shared between processes.
+
+    Parameters
+    ----------
+    folder : str
+        Store folder; created when the first query is saved.
+    max_bytes : int or None, optional
+        Maximum total size of the stored files.  If `None` (default), the
+        store is unbounded.
+    """
+
+    def __init__(self, folder, max_bytes=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+
+    def _path(self, key):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, digest + '.npz')
+
+    def __contains__(self, key):
+        return os.path.isfile(self._path(key))
+
+    def save(self, key, **arrays):
+        """Save `arrays` under `key`, replacing any existing entry."""
+        os.makedirs(self.folder, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first so readers never see partial files.
+        # Its name is unique, so concurrent saves of a key don't clash.
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp.npz', dir=self.folder)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, _key=np.array(key), **arrays)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if self.max_bytes is not None:
+            self._evict(keep=path)
+
+    def load(self, key):
+        """Arrays saved under `key` as a dict, or `None` if there are none."""
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                if data['_key'] != key:
+                    return None
+                arrays = {name: data[name] for name in data.files
+                          if name != '_key'}
+        except (IOError, OSError):
+            return None
+        if self.max_bytes is not None:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return arrays
+
+    def _entries(self):
+        """Modification time, size and path of each stored file."""
+        if not os.path.isdir(self.folder):
+            return []
+        entries = []
+        for name in os.listdir(self.folder):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # Removed by another process.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def nbytes(self):
+        """Total size of the stored files."""
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self, keep):
+        """Delete least recently used files (except `keep`) to fit budget."""
+        entries = sorted(self._entries())
+        nbytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if nbytes <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            nbytes -= size
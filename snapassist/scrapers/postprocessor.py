@@ -5,6 +5,9 @@ import datetime
 import unidecode as ud
 import re
 
+from .. import database
+from .. import mapping
+
 
 def combine_master_tables(raw_master_table, outname):
     tables = pd.HDFStore(raw_master_table, 'r')
@@ -65,7 +68,8 @@ def read_and_preprocess_tables(
         master_table='master_table.hdf5',
         popular_table='popular_table.hdf5',
         master_table_processed='master_table_processed.hdf5',
-        popular_table_processed='popular_table_processed.hdf5'):
+        popular_table_processed='popular_table_processed.hdf5',
+        search_bundle='search_bundle'):
 
     # Read tables.
     mtab = pd.read_hdf(table_folder + master_table, 'table')
@@ -80,5 +84,16 @@ def read_and_preprocess_tables(
     extract_times(mtab)
     extract_times(poptab)
 
+    # Format EXIF data for display once, rather than every time a map is made.
+    poptab = poptab.join(mapping.format_exif(poptab))
+
     mtab.to_hdf(table_folder + master_table_processed, 'table')
     poptab.to_hdf(table_folder + popular_table_processed, 'table')
+
+    # Build index: precompute the tag vocabulary, tag index and statistics so
+    # the web app can load them rather than derive them on startup.
+    if search_bundle:
+        database.build_search_bundle(
+            table_folder + search_bundle, mtab, poptab,
+            main_table=table_folder + master_table_processed,
+            popular_table=table_folder + popular_table_processed)
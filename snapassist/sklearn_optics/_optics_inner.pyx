@@ -1,9 +1,10 @@
+# cython: legacy_implicit_noexcept=True
 cimport numpy as np
 import numpy as np
 cimport cython
 
 ctypedef np.float64_t DTYPE_t
-ctypedef np.int_t DTYPE
+ctypedef np.intp_t DTYPE
 
 # as defined in PEP485 (python3.5)
 cdef inline isclose(double a, 
@@ -36,3 +37,145 @@ cpdef quick_scan(double[:] rdists, double[:] dists):
                 dist = dists[i]
                 idx = i
     return idx
+
+
+cdef class IndexedMinHeap:
+    """Indexed binary min-heap of points, keyed on their reachability.
+
+    The heap holds the OPTICS seed list: unprocessed points with a finite
+    reachability distance.  Keys are read from and written to `keys` (the
+    reachability array) directly, and each point's heap position is tracked
+    so its key can be decreased in place.  Ties are broken by point index.
+    """
+    cdef double[::1] keys
+    cdef DTYPE[::1] heap
+    cdef DTYPE[::1] position
+    cdef Py_ssize_t size
+
+    def __init__(self, double[::1] keys):
+        self.keys = keys
+        self.heap = np.empty(keys.shape[0], dtype=np.intp)
+        self.position = np.full(keys.shape[0], -1, dtype=np.intp)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline bint _less(self, DTYPE a, DTYPE b) nogil:
+        return (self.keys[a] < self.keys[b] or
+                (self.keys[a] == self.keys[b] and a < b))
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef inline void _place(self, Py_ssize_t i, DTYPE point) nogil:
+        self.heap[i] = point
+        self.position[point] = i
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _sift_up(self, Py_ssize_t i) nogil:
+        cdef DTYPE point = self.heap[i]
+        cdef Py_ssize_t parent
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self._less(point, self.heap[parent]):
+                break
+            self._place(i, self.heap[parent])
+            i = parent
+        self._place(i, point)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _sift_down(self, Py_ssize_t i) nogil:
+        cdef DTYPE point = self.heap[i]
+        cdef Py_ssize_t child
+        while 2 * i + 1 < self.size:
+            child = 2 * i + 1
+            if (child + 1 < self.size and
+                    self._less(self.heap[child + 1], self.heap[child])):
+                child += 1
+            if not self._less(self.heap[child], point):
+                break
+            self._place(i, self.heap[child])
+            i = child
+        self._place(i, point)
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void decrease(self, DTYPE point, double key) nogil:
+        """Lower `point`'s key to `key` if smaller, pushing it if absent."""
+        if not key < self.keys[point]:
+            return
+        self.keys[point] = key
+        if self.position[point] < 0:
+            self._place(self.size, point)
+            self.size += 1
+        self._sift_up(self.position[point])
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef DTYPE pop_min(self) nogil:
+        cdef DTYPE point = self.heap[0]
+        self.position[point] = -1
+        self.size -= 1
+        if self.size > 0:
+            self._place(0, self.heap[self.size])
+            self._sift_down(0)
+        return point
+
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    def update(self, DTYPE[::1] points, double[::1] keys):
+        """Decrease the keys of `points` to `keys`, where smaller."""
+        cdef Py_ssize_t i
+        for i in range(points.shape[0]):
+            self.decrease(points[i], keys[i])
+
+    def pop(self):
+        """Remove and return the point with the smallest key."""
+        if self.size == 0:
+            raise IndexError("pop from an empty heap")
+        return self.pop_min()
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def optics_ordering(DTYPE[::1] indptr, DTYPE[::1] indices,
+                    double[::1] distances, double[::1] core_distances,
+                    double[::1] reachability, double max_eps):
+    """Order points and update `reachability` in place, without the GIL.
+
+    The `max_eps` neighborhoods are read from a CSR neighbors graph given
+    by `indptr`, `indices` and `distances`.  Returns the OPTICS ordering.
+    """
+    cdef Py_ssize_t n_samples = core_distances.shape[0]
+    cdef DTYPE[::1] ordering = np.empty(n_samples, dtype=np.intp)
+    cdef unsigned char[::1] processed = np.zeros(n_samples, dtype=np.uint8)
+    cdef IndexedMinHeap seeds = IndexedMinHeap(reachability)
+    cdef Py_ssize_t start, j
+    cdef Py_ssize_t ordering_idx = 0
+    cdef DTYPE point, neighbor
+    cdef double core_distance
+
+    with nogil:
+        for start in range(n_samples):
+            if processed[start]:
+                continue
+            point = start
+            while True:
+                processed[point] = 1
+                ordering[ordering_idx] = point
+                ordering_idx += 1
+                core_distance = core_distances[point]
+                if core_distance <= max_eps:
+                    for j in range(indptr[point], indptr[point + 1]):
+                        neighbor = indices[j]
+                        if not processed[neighbor]:
+                            seeds.decrease(neighbor,
+                                           max(distances[j], core_distance))
+                if seeds.size == 0:
+                    break
+                point = seeds.pop_min()
+    return np.asarray(ordering)
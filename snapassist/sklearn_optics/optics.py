@@ -16,6 +16,8 @@ License: BSD 3 clause
 from __future__ import division
 import warnings
 import numpy as np
+from scipy.ndimage import maximum_filter1d
+from scipy.sparse import csr_matrix
 
 from sklearn.utils import check_array
 from sklearn.utils import gen_batches, get_chunk_n_rows
@@ -23,7 +25,7 @@ from sklearn.utils.validation import check_is_fitted
 from sklearn.neighbors import NearestNeighbors
 from sklearn.base import BaseEstimator, ClusterMixin
 from sklearn.metrics import pairwise_distances
-from ._optics_inner import quick_scan
+from ._optics_inner import quick_scan, IndexedMinHeap, optics_ordering
 
 
 def optics(X, min_samples=5, max_eps=np.inf, metric='euclidean',
@@ -31,7 +33,8 @@ def optics(X, min_samples=5, max_eps=np.inf, metric='euclidean',
            rejection_ratio=.7, similarity_threshold=0.4,
            significant_min=.003, min_cluster_size=.005,
            min_maxima_ratio=0.001, algorithm='ball_tree',
-           leaf_size=30, n_jobs=None):
+           leaf_size=30, n_jobs=None, legacy_ordering=False,
+           precompute_neighbors=False):
     """Perform OPTICS clustering from vector array
 
     OPTICS: Ordering Points To Identify the Clustering Structure
@@ -152,6 +155,22 @@ def optics(X, min_samples=5, max_eps=np.inf, metric='euclidean',
         ``-1`` means using all processors. See :term:`Glossary <n_jobs>`
         for more details.
 
+    legacy_ordering : bool, optional (default=False)
+        If True, use the ordering of the original scikit-learn implementation,
+        which picks each next point only from the unprocessed neighbors of
+        the current one, rather than from the global seed list.  Kept for
+        comparison with earlier results.
+
+    precompute_neighbors : bool, optional (default=False)
+        If True, find the `max_eps` neighborhoods of all points up front, in
+        chunks bounded by ``sklearn.get_config()['working_memory']``, and
+        store them as a sparse distance graph.  The ordering loop then reads
+        from the graph in Cython without holding the GIL, rather than making
+        one neighbors query per point.  This is much faster, but the graph
+        has one entry per pair of points within `max_eps`, so it should only
+        be used when `max_eps` is small enough for the neighborhoods to fit
+        in memory.
+
     Returns
     -------
     core_sample_indices_ : array, shape (n_core_samples,)
@@ -179,7 +198,8 @@ def optics(X, min_samples=5, max_eps=np.inf, metric='euclidean',
                    maxima_ratio, rejection_ratio,
                    similarity_threshold, significant_min,
                    min_cluster_size, min_maxima_ratio,
-                   algorithm, leaf_size, n_jobs)
+                   algorithm, leaf_size, n_jobs, legacy_ordering,
+                   precompute_neighbors)
     clust.fit(X)
     return clust.core_sample_indices_, clust.labels_
 
@@ -302,6 +322,22 @@ class OPTICS(BaseEstimator, ClusterMixin):
         ``-1`` means using all processors. See :term:`Glossary <n_jobs>`
         for more details.
 
+    legacy_ordering : bool, optional (default=False)
+        If True, use the ordering of the original scikit-learn implementation,
+        which picks each next point only from the unprocessed neighbors of
+        the current one, rather than from the global seed list.  Kept for
+        comparison with earlier results.
+
+    precompute_neighbors : bool, optional (default=False)
+        If True, find the `max_eps` neighborhoods of all points up front, in
+        chunks bounded by ``sklearn.get_config()['working_memory']``, and
+        store them as a sparse distance graph.  The ordering loop then reads
+        from the graph in Cython without holding the GIL, rather than making
+        one neighbors query per point.  This is much faster, but the graph
+        has one entry per pair of points within `max_eps`, so it should only
+        be used when `max_eps` is small enough for the neighborhoods to fit
+        in memory.
+
     Attributes
     ----------
     core_sample_indices_ : array, shape (n_core_samples,)
@@ -342,7 +378,8 @@ class OPTICS(BaseEstimator, ClusterMixin):
                  rejection_ratio=.7, similarity_threshold=0.4,
                  significant_min=.003, min_cluster_size=.005,
                  min_maxima_ratio=0.001, algorithm='ball_tree',
-                 leaf_size=30, n_jobs=None):
+                 leaf_size=30, n_jobs=None, legacy_ordering=False,
+                 precompute_neighbors=False):
 
         self.max_eps = max_eps
         self.min_samples = min_samples
@@ -358,8 +395,10 @@ class OPTICS(BaseEstimator, ClusterMixin):
         self.p = p
         self.leaf_size = leaf_size
         self.n_jobs = n_jobs
+        self.legacy_ordering = legacy_ordering
+        self.precompute_neighbors = precompute_neighbors
 
-    def fit(self, X, y=None):
+    def fit(self, X, y=None, neighbors_graph=None):
         """Perform OPTICS clustering
 
         Extracts an ordered list of points and reachability distances, and
@@ -373,6 +412,14 @@ class OPTICS(BaseEstimator, ClusterMixin):
 
         y : ignored
 
+        neighbors_graph : sparse matrix, shape (n_samples, n_samples), optional
+            Precomputed `max_eps` neighborhoods of `X`, in the form returned
+            by ``NearestNeighbors.radius_neighbors_graph(X, max_eps,
+            mode='distance')`` but with each sample's zero distance to itself
+            stored explicitly.  If given, no neighbors searches are run, and
+            samples with fewer than `min_samples` neighbors within `max_eps`
+            get core distances of inf.
+
         Returns
         -------
         self : instance of OPTICS
@@ -388,16 +435,7 @@ class OPTICS(BaseEstimator, ClusterMixin):
                              "used for clustering." %
                              (n_samples, self.min_samples))
 
-        if self.min_cluster_size <= 0 or (self.min_cluster_size !=
-                                          int(self.min_cluster_size)
-                                          and self.min_cluster_size > 1):
-            raise ValueError('min_cluster_size must be a positive integer or '
-                             'a float between 0 and 1. Got %r' %
-                             self.min_cluster_size)
-        elif self.min_cluster_size > n_samples:
-            raise ValueError('min_cluster_size must be no greater than the '
-                             'number of samples (%d). Got %d' %
-                             (n_samples, self.min_cluster_size))
+        _validate_min_cluster_size(self.min_cluster_size, n_samples)
 
         # Start all points as 'unprocessed' ##
         self.reachability_ = np.empty(n_samples)
@@ -405,15 +443,28 @@ class OPTICS(BaseEstimator, ClusterMixin):
         # Start all points as noise ##
         self.labels_ = np.full(n_samples, -1, dtype=int)
 
-        nbrs = NearestNeighbors(n_neighbors=self.min_samples,
-                                algorithm=self.algorithm,
-                                leaf_size=self.leaf_size, metric=self.metric,
-                                metric_params=self.metric_params, p=self.p,
-                                n_jobs=self.n_jobs)
-
-        nbrs.fit(X)
-        self.core_distances_ = self._compute_core_distances_(X, nbrs)
-        self.ordering_ = self._calculate_optics_order(X, nbrs)
+        if neighbors_graph is not None:
+            nbrs = None
+            graph = csr_matrix(neighbors_graph)
+            self.core_distances_ = self._core_distances_from_graph(graph)
+        else:
+            nbrs = NearestNeighbors(n_neighbors=self.min_samples,
+                                    algorithm=self.algorithm,
+                                    leaf_size=self.leaf_size,
+                                    metric=self.metric,
+                                    metric_params=self.metric_params,
+                                    p=self.p, n_jobs=self.n_jobs)
+
+            nbrs.fit(X)
+            self.core_distances_ = self._compute_core_distances_(X, nbrs)
+            if self.precompute_neighbors:
+                graph = self._compute_neighbors_graph(X, nbrs)
+            else:
+                graph = None
+        if self.legacy_ordering:
+            self.ordering_ = self._calculate_legacy_order(X, nbrs, graph)
+        else:
+            self.ordering_ = self._calculate_optics_order(X, nbrs, graph)
 
         indices_, self.labels_ = _extract_optics(self.ordering_,
                                                  self.reachability_,
@@ -426,6 +477,35 @@ class OPTICS(BaseEstimator, ClusterMixin):
         self.core_sample_indices_ = indices_
         return self
 
+    def set_reachability(self, ordering, reachability, core_distances):
+        """Restore a previous fit and extract clusters from it
+
+        Takes the `ordering_`, `reachability_` and `core_distances_` of an
+        earlier fit (eg. one saved to disk) in place of calling `fit`, which
+        skips the neighbors search entirely.
+
+        Parameters
+        ----------
+        ordering : array, shape (n_samples,)
+            The cluster ordered list of sample indices.
+
+        reachability : array, shape (n_samples,)
+            Reachability distances per sample, indexed by object order.
+
+        core_distances : array, shape (n_samples,)
+            Core distances per sample, indexed by object order.
+
+        Returns
+        -------
+        self : instance of OPTICS
+            The instance.
+        """
+        self.ordering_ = np.asarray(ordering, dtype=int)
+        self.reachability_ = np.asarray(reachability, dtype=np.float64)
+        self.core_distances_ = np.asarray(core_distances, dtype=np.float64)
+        self.core_sample_indices_, self.labels_ = self.extract_optics()
+        return self
+
     # OPTICS helper functions
 
     def _compute_core_distances_(self, X, neighbors, working_memory=None):
@@ -464,28 +544,124 @@ class OPTICS(BaseEstimator, ClusterMixin):
                 X[sl], self.min_samples)[0][:, -1]
         return core_distances
 
-    def _calculate_optics_order(self, X, nbrs):
+    def _core_distances_from_graph(self, graph):
+        """Core distances read from a precomputed neighbors graph
+
+        Matches `_compute_core_distances_` for samples with at least
+        `min_samples` neighbors in the graph, and is inf for the rest.
+        """
+        n_samples = graph.shape[0]
+        core_distances = np.empty(n_samples)
+        core_distances.fill(np.inf)
+        # Sort distances within each row, then read each row's kth smallest.
+        rows = np.repeat(np.arange(n_samples), np.diff(graph.indptr))
+        distances = graph.data[np.lexsort((graph.data, rows))]
+        kth = self.min_samples - 1
+        has_core = np.diff(graph.indptr) > kth
+        core_distances[has_core] = distances[graph.indptr[:-1][has_core] +
+                                             kth]
+        return core_distances
+
+    def _compute_neighbors_graph(self, X, neighbors, working_memory=None):
+        """Compute the `max_eps` neighborhood of each sample
+
+        Equivalent to neighbors.radius_neighbors_graph(X, self.max_eps,
+        mode='distance') but with more memory efficiency while querying.
+
+        Parameters
+        ----------
+        X : array, shape (n_samples, n_features)
+            The data.
+        neighbors : NearestNeighbors instance
+            The fitted nearest neighbors estimator.
+        working_memory : int, optional
+            The sought maximum memory for temporary neighborhood chunks.
+            When None (default), the value of
+            ``sklearn.get_config()['working_memory']`` is used.
+
+        Returns
+        -------
+        graph : sparse matrix in CSR format, shape (n_samples, n_samples)
+            Distances from each sample to the samples within `max_eps` of it,
+            including itself.  Zero distances are stored explicitly.
+        """
+        n_samples = len(X)
+        # A neighborhood may hold every sample; budget for an index and a
+        # distance per sample so a chunk never exceeds working_memory.
+        chunk_n_rows = get_chunk_n_rows(row_bytes=16 * n_samples,
+                                        max_n_rows=n_samples,
+                                        working_memory=working_memory)
+        indptr = np.zeros(n_samples + 1, dtype=np.intp)
+        indices = []
+        distances = []
+        for sl in gen_batches(n_samples, chunk_n_rows):
+            dist, ind = neighbors.radius_neighbors(X[sl], radius=self.max_eps,
+                                                   return_distance=True)
+            indptr[sl.start + 1:sl.stop + 1] = [len(i) for i in ind]
+            indices.extend(ind)
+            distances.extend(dist)
+        np.cumsum(indptr, out=indptr)
+        indices = np.concatenate(indices).astype(np.intp, copy=False)
+        distances = np.concatenate(distances).astype(np.float64, copy=False)
+        return csr_matrix((distances, indices, indptr),
+                          shape=(n_samples, n_samples))
+
+    def _calculate_optics_order(self, X, nbrs, graph=None):
         # Main OPTICS loop. Not parallelizable. The order that entries are
         # written to the 'ordering_' list is important!
-        processed = np.zeros(X.shape[0], dtype=bool)
-        ordering = np.zeros(X.shape[0], dtype=int)
+        # Unprocessed points with a finite reachability are kept in an
+        # indexed min-heap (the seed list), so the next point is always the
+        # globally closest seed.  With a neighbors graph the whole loop runs
+        # in Cython without the GIL.
+        if graph is not None:
+            return optics_ordering(
+                np.ascontiguousarray(graph.indptr, dtype=np.intp),
+                np.ascontiguousarray(graph.indices, dtype=np.intp),
+                np.ascontiguousarray(graph.data, dtype=np.float64),
+                np.ascontiguousarray(self.core_distances_, dtype=np.float64),
+                self.reachability_, self.max_eps)
+
+        n_samples = X.shape[0]
+        processed = np.zeros(n_samples, dtype=bool)
+        ordering = np.zeros(n_samples, dtype=int)
+        seeds = IndexedMinHeap(self.reachability_)
         ordering_idx = 0
-        for point in range(X.shape[0]):
-            if processed[point]:
+        for start in range(n_samples):
+            if processed[start]:
                 continue
-            if self.core_distances_[point] <= self.max_eps:
-                while not processed[point]:
-                    processed[point] = True
-                    ordering[ordering_idx] = point
-                    ordering_idx += 1
-                    point = self._set_reach_dist(point, processed, X, nbrs)
-            else:  # For very noisy points
+            point = start
+            while True:
+                processed[point] = True
                 ordering[ordering_idx] = point
                 ordering_idx += 1
-                processed[point] = True
+                if self.core_distances_[point] <= self.max_eps:
+                    self._update_seeds(point, processed, X, nbrs, graph,
+                                       seeds)
+                if not len(seeds):
+                    break
+                point = seeds.pop()
         return ordering
 
-    def _set_reach_dist(self, point_index, processed, X, nbrs):
+    def _update_seeds(self, point_index, processed, X, nbrs, graph, seeds):
+        unproc, dists = self._unprocessed_neighbors(point_index, processed,
+                                                    X, nbrs, graph)
+        if not unproc.size:
+            return
+
+        rdists = np.maximum(dists, self.core_distances_[point_index])
+        seeds.update(np.ascontiguousarray(unproc, dtype=np.intp),
+                     np.ascontiguousarray(rdists, dtype=np.float64))
+
+    def _unprocessed_neighbors(self, point_index, processed, X, nbrs, graph):
+        # Indices of, and distances to, the unprocessed points within max_eps
+        # of point_index, read from the neighbors graph when there is one.
+        if graph is not None:
+            row = slice(graph.indptr[point_index],
+                        graph.indptr[point_index + 1])
+            indices = graph.indices[row]
+            mask = ~np.take(processed, indices)
+            return indices[mask], graph.data[row][mask]
+
         P = X[point_index:point_index + 1]
         indices = nbrs.radius_neighbors(P, radius=self.max_eps,
                                         return_distance=False)[0]
@@ -495,14 +671,43 @@ class OPTICS(BaseEstimator, ClusterMixin):
                              indices, axis=0)
         # Keep n_jobs = 1 in the following lines...please
         if not unproc.size:
-            # Everything is already processed. Return to main loop
-            return point_index
+            return unproc, np.empty(0)
 
         if self.metric == 'precomputed':
             dists = X[point_index, unproc]
         else:
             dists = pairwise_distances(P, np.take(X, unproc, axis=0),
                                        self.metric, n_jobs=None).ravel()
+        return unproc, dists
+
+    def _calculate_legacy_order(self, X, nbrs, graph=None):
+        # Original scikit-learn ordering loop, which only picks the next point
+        # from the current point's unprocessed neighbors.
+        processed = np.zeros(X.shape[0], dtype=bool)
+        ordering = np.zeros(X.shape[0], dtype=int)
+        ordering_idx = 0
+        for point in range(X.shape[0]):
+            if processed[point]:
+                continue
+            if self.core_distances_[point] <= self.max_eps:
+                while not processed[point]:
+                    processed[point] = True
+                    ordering[ordering_idx] = point
+                    ordering_idx += 1
+                    point = self._set_reach_dist(point, processed, X, nbrs,
+                                                 graph)
+            else:  # For very noisy points
+                ordering[ordering_idx] = point
+                ordering_idx += 1
+                processed[point] = True
+        return ordering
+
+    def _set_reach_dist(self, point_index, processed, X, nbrs, graph=None):
+        unproc, dists = self._unprocessed_neighbors(point_index, processed,
+                                                    X, nbrs, graph)
+        if not unproc.size:
+            # Everything is already processed. Return to main loop
+            return point_index
 
         rdists = np.maximum(dists, self.core_distances_[point_index])
         new_reach = np.minimum(np.take(self.reachability_, unproc), rdists)
@@ -512,6 +717,41 @@ class OPTICS(BaseEstimator, ClusterMixin):
         return (unproc[quick_scan(np.take(self.reachability_, unproc),
                                   dists)])
 
+    def extract_optics(self, maxima_ratio=None, rejection_ratio=None,
+                       similarity_threshold=None, significant_min=None,
+                       min_cluster_size=None, min_maxima_ratio=None):
+        """Performs automatic cluster extraction with new parameters.
+
+        Reuses the ordering and reachability distances of the last fit, so
+        extraction runs without any neighbors queries.  Parameters left as
+        None take the values given at OPTICS object instantiation; see the
+        class docstring for their meaning.
+
+        Returns
+        -------
+        core_sample_indices_ : array, shape (n_core_samples,)
+            The indices of the core samples.
+
+        labels_ : array, shape (n_samples,)
+            The estimated labels.
+        """
+        check_is_fitted(self, 'reachability_')
+
+        def param(value, default):
+            return default if value is None else value
+
+        min_cluster_size = param(min_cluster_size, self.min_cluster_size)
+        _validate_min_cluster_size(min_cluster_size, len(self.ordering_))
+
+        return _extract_optics(
+            self.ordering_, self.reachability_,
+            param(maxima_ratio, self.maxima_ratio),
+            param(rejection_ratio, self.rejection_ratio),
+            param(similarity_threshold, self.similarity_threshold),
+            param(significant_min, self.significant_min),
+            min_cluster_size,
+            param(min_maxima_ratio, self.min_maxima_ratio))
+
     def extract_dbscan(self, eps):
         """Performs DBSCAN extraction for an arbitrary epsilon.
 
@@ -552,6 +792,18 @@ class OPTICS(BaseEstimator, ClusterMixin):
                                self.reachability_, eps)
 
 
+def _validate_min_cluster_size(min_cluster_size, n_samples):
+    if min_cluster_size <= 0 or (min_cluster_size != int(min_cluster_size)
+                                 and min_cluster_size > 1):
+        raise ValueError('min_cluster_size must be a positive integer or '
+                         'a float between 0 and 1. Got %r' %
+                         min_cluster_size)
+    elif min_cluster_size > n_samples:
+        raise ValueError('min_cluster_size must be no greater than the '
+                         'number of samples (%d). Got %d' %
+                         (n_samples, min_cluster_size))
+
+
 def _extract_dbscan(ordering, core_distances, reachability, eps):
     """Performs DBSCAN extraction for an arbitrary epsilon (`eps`).
 
@@ -646,7 +898,7 @@ def _extract_optics(ordering, reachability, maxima_ratio=.75,
 
     # Extraction wrapper
     reachability = reachability / np.max(reachability[1:])
-    reachability_plot = reachability[ordering].tolist()
+    reachability_plot = reachability[ordering]
     root_node = _automatic_cluster(reachability_plot, ordering,
                                    maxima_ratio, rejection_ratio,
                                    similarity_threshold, significant_min,
@@ -675,7 +927,7 @@ def _automatic_cluster(reachability_plot, ordering,
     Parameters
     ----------
 
-    reachability_plot : list, required
+    reachability_plot : array, required
         Reachability distances ordered by OPTICS ordering index.
 
     """
@@ -691,10 +943,9 @@ def _automatic_cluster(reachability_plot, ordering,
 
     local_maxima_points = _find_local_maxima(reachability_plot,
                                              neighborhood_size)
-    root_node = _TreeNode(ordering, 0, len(ordering), None)
-    _cluster_tree(root_node, None, local_maxima_points,
-                  reachability_plot, ordering, min_cluster_size,
-                  maxima_ratio, rejection_ratio,
+    root_node = _TreeNode(0, len(ordering), None)
+    _cluster_tree(root_node, local_maxima_points, reachability_plot,
+                  min_cluster_size, maxima_ratio, rejection_ratio,
                   similarity_threshold, significant_min)
 
     return root_node
@@ -702,8 +953,10 @@ def _automatic_cluster(reachability_plot, ordering,
 
 class _TreeNode(object):
     # automatic cluster helper classes and functions
-    def __init__(self, points, start, end, parent_node):
-        self.points = points
+    # A node covers reachability plot positions start:end.
+    __slots__ = ('start', 'end', 'parent_node', 'children', 'split_point')
+
+    def __init__(self, start, end, parent_node):
         self.start = start
         self.end = end
         self.parent_node = parent_node
@@ -711,148 +964,167 @@ class _TreeNode(object):
         self.split_point = -1
 
 
-def _is_local_maxima(index, reachability_plot, neighborhood_size):
-    right_idx = slice(index + 1, index + neighborhood_size + 1)
-    left_idx = slice(max(1, index - neighborhood_size - 1), index)
-    return (np.all(reachability_plot[index] >= reachability_plot[left_idx]) and
-            np.all(reachability_plot[index] >= reachability_plot[right_idx]))
+def _sliding_max(values, width):
+    # Maximum of each trailing window values[j - width + 1:j + 1], clipped at
+    # the start of the array.
+    padded = np.concatenate((np.full(width - 1, -np.inf), values))
+    start = width // 2
+    return maximum_filter1d(padded, size=width)[start:start + len(values)]
 
 
 def _find_local_maxima(reachability_plot, neighborhood_size):
-    local_maxima_points = {}
-    # 1st and last points on Reachability Plot are not taken
-    # as local maxima points
-    for i in range(1, len(reachability_plot) - 1):
-        # if the point is a local maxima on the reachability plot with
-        # regard to neighborhood_size, insert it into priority queue and
-        # maxima list
-        if (reachability_plot[i] > reachability_plot[i - 1] and
-            reachability_plot[i] >= reachability_plot[i + 1] and
-            _is_local_maxima(i, np.array(reachability_plot),
-                             neighborhood_size) == 1):
-            local_maxima_points[i] = reachability_plot[i]
-
-    return sorted(local_maxima_points,
-                  key=local_maxima_points.__getitem__, reverse=True)
-
-
-def _cluster_tree(node, parent_node, local_maxima_points,
-                  reachability_plot, reachability_ordering,
+    """Indices of local maxima, sorted by descending reachability.
+
+    A point is a local maximum if it is larger than the point before it, and
+    at least as large as the point after it and every point within
+    `neighborhood_size + 1` before and `neighborhood_size` after it.  The
+    first and last points are never local maxima, and the first point is
+    excluded from the neighborhoods.  Ties are sorted by index.
+    """
+    reachability_plot = np.asarray(reachability_plot, dtype=np.float64)
+    n_points = len(reachability_plot)
+    if n_points < 3:
+        return []
+
+    # NaNs never compare as smaller, so windows containing one are flagged
+    # separately and take part in the maximum as inf.
+    is_nan = np.isnan(reachability_plot)
+    is_nan[0] = False
+    values = np.where(is_nan, np.inf, reachability_plot)
+    values[0] = -np.inf
+    n_nan = np.concatenate(([0], np.cumsum(is_nan)))
+
+    index = np.arange(1, n_points - 1)
+    point = reachability_plot[index]
+    # Left neighborhood reachability_plot[max(1, i - size - 1):i].
+    left_max = _sliding_max(values, neighborhood_size + 1)[index - 1]
+    left_nan = (n_nan[index] -
+                n_nan[np.maximum(1, index - neighborhood_size - 1)])
+    # Right neighborhood reachability_plot[i + 1:i + size + 1].
+    right_end = np.minimum(index + neighborhood_size, n_points - 1)
+    right_max = _sliding_max(values[::-1],
+                             neighborhood_size)[::-1][index + 1]
+    right_nan = n_nan[right_end + 1] - n_nan[index + 1]
+
+    is_maximum = ((point > reachability_plot[index - 1]) &
+                  (point >= reachability_plot[index + 1]) &
+                  (point >= left_max) & (left_nan == 0) &
+                  (point >= right_max) & (right_nan == 0))
+    maxima = index[is_maximum]
+    return maxima[np.argsort(-reachability_plot[maxima],
+                             kind='mergesort')].tolist()
+
+
+def _cluster_tree(root_node, local_maxima_points, reachability_plot,
                   min_cluster_size, maxima_ratio, rejection_ratio,
                   similarity_threshold, significant_min):
-    """Recursively builds cluster tree to hold hierarchical cluster structure
+    """Builds cluster tree to hold hierarchical cluster structure
 
-    node is a node or the root of the tree in the first call
-    parent_node is parent node of N or None if node is root of the tree
+    root_node is the root of the tree, spanning the whole reachability plot
     local_maxima_points is list of local maxima points sorted in
     descending order of reachability
+
+    Nodes are split depth first using an explicit stack.  Each task on the
+    stack is a node, its parent, the range [lo, hi) of maxima (sorted by
+    position) that fall inside it, and the rank of the split that created
+    it.  Only maxima ranked after that split are candidates for the node.
     """
+    rank_order = np.asarray(local_maxima_points, dtype=np.intp)
+    by_position = np.argsort(rank_order, kind='mergesort')
+    maxima_positions = rank_order[by_position]
+    # Rank of each maximum, in position order.
+    maxima_ranks = by_position
 
-    if len(local_maxima_points) == 0:
-        return  # parent_node is a leaf
-
-    # take largest local maximum as possible separation between clusters
-    s = local_maxima_points[0]
-    node.split_point = s
-    local_maxima_points = local_maxima_points[1:]
-
-    # create two new nodes and add to list of nodes
-    node_1 = _TreeNode(reachability_ordering[node.start:s],
-                       node.start, s, node)
-    node_2 = _TreeNode(reachability_ordering[s + 1:node.end],
-                       s + 1, node.end, node)
-    local_max_1 = []
-    local_max_2 = []
-
-    for i in local_maxima_points:
-        if i < s:
-            local_max_1.append(i)
-        if i > s:
-            local_max_2.append(i)
-
-    node_list = []
-    node_list.append((node_1, local_max_1))
-    node_list.append((node_2, local_max_2))
-
-    if reachability_plot[s] < significant_min:
-        node.split_point = -1
-        # if split_point is not significant, ignore this split and continue
-        return
-
-    # only check a certain ratio of points in the child
+    # Only check a certain ratio of points in the child
     # nodes formed to the left and right of the maxima
     # ...should check_ratio be a user settable parameter?
     check_ratio = .8
-    check_value_1 = int(np.round(check_ratio * len(node_1.points)))
-    check_value_2 = int(np.round(check_ratio * len(node_2.points)))
-    avg_reach1 = np.mean(reachability_plot[(node_1.end -
-                                            check_value_1):node_1.end])
-    avg_reach2 = np.mean(reachability_plot[node_2.start:(node_2.start
-                                                         + check_value_2)])
-
-    if ((avg_reach1 / reachability_plot[s]) > maxima_ratio or
-            (avg_reach2 / reachability_plot[s]) > maxima_ratio):
-
-        if (avg_reach1 / reachability_plot[s]) < rejection_ratio:
-            # reject node 2
-            node_list.remove((node_2, local_max_2))
-        if (avg_reach2 / reachability_plot[s]) < rejection_ratio:
-            # reject node 1
-            node_list.remove((node_1, local_max_1))
-        if ((avg_reach1 / reachability_plot[s]) >= rejection_ratio and
-                (avg_reach2 / reachability_plot[s]) >= rejection_ratio):
-            # since split_point is not significant,
-            # ignore this split and continue (reject both child nodes)
-            node.split_point = -1
-            _cluster_tree(node, parent_node, local_maxima_points,
-                          reachability_plot, reachability_ordering,
-                          min_cluster_size, maxima_ratio, rejection_ratio,
-                          similarity_threshold, significant_min)
-            return
 
-    # remove clusters that are too small
-    if (len(node_1.points) < min_cluster_size and
-            node_list.count((node_1, local_max_1)) > 0):
-        # cluster 1 is too small
-        node_list.remove((node_1, local_max_1))
-    if (len(node_2.points) < min_cluster_size and
-            node_list.count((node_2, local_max_2)) > 0):
-        # cluster 2 is too small
-        node_list.remove((node_2, local_max_2))
-    if not node_list:
-        # parent_node will be a leaf
-        node.split_point = -1
-        return
-
-    # Check if nodes can be moved up one level - the new cluster created
-    # is too "similar" to its parent, given the similarity threshold.
-    bypass_node = 0
-    if parent_node is not None:
-        if ((node.end - node.start) / (parent_node.end - parent_node.start) >
-                similarity_threshold):
-
-            parent_node.children.remove(node)
-            bypass_node = 1
-
-    for nl in node_list:
-        if bypass_node == 1:
-            parent_node.children.append(nl[0])
-            _cluster_tree(nl[0], parent_node, nl[1],
-                          reachability_plot, reachability_ordering,
-                          min_cluster_size, maxima_ratio, rejection_ratio,
-                          similarity_threshold, significant_min)
-        else:
-            node.children.append(nl[0])
-            _cluster_tree(nl[0], node, nl[1], reachability_plot,
-                          reachability_ordering, min_cluster_size,
-                          maxima_ratio, rejection_ratio,
-                          similarity_threshold, significant_min)
+    stack = [(root_node, None, 0, len(maxima_positions), -1)]
+    while stack:
+        node, parent_node, lo, hi, min_rank = stack.pop()
+        if parent_node is not None:
+            parent_node.children.append(node)
+
+        # Candidate split points, largest first.
+        candidates = np.sort(maxima_ranks[lo:hi])
+        candidates = candidates[candidates > min_rank]
+        for rank in candidates:
+            # take largest local maximum as possible separation between
+            # clusters
+            s = int(rank_order[rank])
+            node.split_point = s
+
+            if reachability_plot[s] < significant_min:
+                # if split_point is not significant, ignore this split and
+                # continue
+                node.split_point = -1
+                break
+
+            # create two new nodes
+            node_1 = _TreeNode(node.start, s, node)
+            node_2 = _TreeNode(s + 1, node.end, node)
+            keep_1 = keep_2 = True
+
+            check_value_1 = int(np.round(check_ratio * (s - node.start)))
+            check_value_2 = int(np.round(check_ratio * (node.end - s - 1)))
+            avg_reach1 = np.mean(reachability_plot[(node_1.end -
+                                                    check_value_1):node_1.end])
+            avg_reach2 = np.mean(reachability_plot[node_2.start:
+                                                   (node_2.start +
+                                                    check_value_2)])
+            ratio_1 = avg_reach1 / reachability_plot[s]
+            ratio_2 = avg_reach2 / reachability_plot[s]
+
+            if ratio_1 > maxima_ratio or ratio_2 > maxima_ratio:
+                if ratio_1 < rejection_ratio:
+                    # reject node 2
+                    keep_2 = False
+                if ratio_2 < rejection_ratio:
+                    # reject node 1
+                    keep_1 = False
+                if ratio_1 >= rejection_ratio and ratio_2 >= rejection_ratio:
+                    # since split_point is not significant,
+                    # ignore this split and continue (reject both child
+                    # nodes)
+                    node.split_point = -1
+                    continue
+
+            # remove clusters that are too small
+            keep_1 = keep_1 and s - node.start >= min_cluster_size
+            keep_2 = keep_2 and node.end - s - 1 >= min_cluster_size
+            if not (keep_1 or keep_2):
+                # parent_node will be a leaf
+                node.split_point = -1
+                break
+
+            # Check if nodes can be moved up one level - the new cluster
+            # created is too "similar" to its parent, given the similarity
+            # threshold.
+            if (parent_node is not None and
+                    ((node.end - node.start) /
+                     (parent_node.end - parent_node.start) >
+                     similarity_threshold)):
+                parent_node.children.remove(node)
+            else:
+                parent_node = node
+
+            # Children are pushed in reverse so node_1's subtree is built
+            # before node_2 is attached.
+            split = np.searchsorted(maxima_positions, s)
+            if keep_2:
+                stack.append((node_2, parent_node, split + 1, hi, rank))
+            if keep_1:
+                stack.append((node_1, parent_node, lo, split, rank))
+            break
 
 
 def _get_leaves(node, arr):
-    if node is not None:
-        if node.split_point == -1:
-            arr.append(node)
-        for n in node.children:
-            _get_leaves(n, arr)
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is not None:
+            if node.split_point == -1:
+                arr.append(node)
+            stack.extend(reversed(node.children))
     return arr
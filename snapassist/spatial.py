@@ -0,0 +1,155 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from sklearn.neighbors import KDTree
+from sklearn.utils import gen_batches, get_chunk_n_rows
+
+
+class SpatialIndex:
+    """KD-tree over the long/lat of every photo, shared between queries.
+
+    Subsets of photos (eg. search results) are clustered in their own scaled
+    coordinates, where each axis is multiplied by a constant (see
+    `clustering.Clustering.feature_scaling`).  A ball in those coordinates is
+    an ellipse in long/lat, so neighbors are found by querying the tree with
+    the smallest circle enclosing the ellipse, then keeping only candidates
+    that are in the subset and within the ball.  This gives the same
+    neighborhoods as a tree built on the subset, without building one for
+    every query.
+
+    The tree is built on first use, so processes that never query it don't
+    pay for it.
+
+    Parameters
+    ----------
+    longlat : numpy.ndarray
+        Long/lat of every photo, shape (n_photos, 2).
+    leaf_size : int, optional
+        Leaf size of the KD-tree.  Default: 40.
+    """
+
+    def __init__(self, longlat, leaf_size=40):
+        self.longlat = np.ascontiguousarray(longlat, dtype=np.float64)
+        self.leaf_size = leaf_size
+        self._tree = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = KDTree(self.longlat, leaf_size=self.leaf_size)
+        return self._tree
+
+    def __len__(self):
+        return len(self.longlat)
+
+    @staticmethod
+    def _search_radius(scale, radius):
+        # Scaled distances are at least min(scale) times long/lat distances.
+        # Pad slightly so rounding never drops a neighbor.
+        return radius / np.min(scale) * (1. + 1e-6)
+
+    def estimate_graph_size(self, rows, scale, radius, n_samples=100,
+                            n_photo_samples=5000, random_state=0):
+        """Estimate the number of candidates `radius_neighbors_graph` checks.
+
+        Counts the photos of a random sample of all photos within the search
+        radius of a random sample of `rows`, by brute force, so the tree
+        isn't needed to decide whether it's worth using.
+
+        Parameters
+        ----------
+        rows, scale, radius
+            As in `radius_neighbors_graph`.
+        n_samples : int, optional
+            Number of rows to sample.  Default: 100.
+        n_photo_samples : int, optional
+            Number of photos to count neighbors among.  Default: 5000.
+        random_state : int, optional
+            Seed for sampling.  Default: 0.
+
+        Returns
+        -------
+        n_candidates : int
+            Estimated number of (subset photo, photo) pairs within the search
+            radius.
+        """
+        rows = np.asarray(rows)
+        random_state = np.random.RandomState(random_state)
+        if len(rows) > n_samples:
+            sample = random_state.choice(rows, n_samples, replace=False)
+        else:
+            sample = rows
+        if len(self) > n_photo_samples:
+            photos = self.longlat[random_state.randint(0, len(self),
+                                                       n_photo_samples)]
+        else:
+            photos = self.longlat
+        squared = ((self.longlat[sample, np.newaxis, :] -
+                    photos[np.newaxis, :, :])**2).sum(axis=2)
+        fraction = np.mean(squared <= self._search_radius(scale, radius)**2)
+        return int(fraction * len(self) * len(rows))
+
+    def radius_neighbors_graph(self, rows, X, scale, radius,
+                               working_memory=None):
+        """Neighbors within `radius` of each photo of a subset.
+
+        Equivalent to
+        ``NearestNeighbors().fit(X).radius_neighbors_graph(X, radius,
+        mode='distance')``, but with zero distances stored explicitly.
+
+        Parameters
+        ----------
+        rows : numpy.ndarray
+            Positions of the subset's photos in `longlat`.
+        X : numpy.ndarray
+            Scaled coordinates of the subset's photos, shape (len(rows), 2).
+        scale : array-like
+            Factor each long/lat axis is multiplied by in `X`.  Only used to
+            bound the search, so any offset between the two is ignored.
+        radius : float
+            Neighborhood radius, in scaled coordinates.
+        working_memory : int, optional
+            The sought maximum memory for temporary candidate chunks.  When
+            None (default), the value of
+            ``sklearn.get_config()['working_memory']`` is used.
+
+        Returns
+        -------
+        graph : sparse matrix in CSR format, shape (len(rows), len(rows))
+            Distances between photos of the subset within `radius`.
+        """
+        rows = np.asarray(rows)
+        n_rows = len(rows)
+        # Position of each photo in the subset, or -1 if not in it.
+        subset_position = np.full(len(self), -1, dtype=np.intp)
+        subset_position[rows] = np.arange(n_rows)
+        search_radius = self._search_radius(scale, radius)
+        # Match the tree's comparison of squared distances.
+        squared_radius = radius * radius
+
+        # A candidate list can hold every photo in the corpus.
+        chunk_n_rows = get_chunk_n_rows(row_bytes=16 * len(self),
+                                        max_n_rows=n_rows,
+                                        working_memory=working_memory)
+        indptr = np.zeros(n_rows + 1, dtype=np.intp)
+        indices = []
+        distances = []
+        for sl in gen_batches(n_rows, chunk_n_rows):
+            candidates = self.tree.query_radius(self.longlat[rows[sl]],
+                                                search_radius)
+            counts = [len(c) for c in candidates]
+            source = np.repeat(np.arange(sl.start, sl.stop), counts)
+            target = subset_position[np.concatenate(candidates)]
+            in_subset = target >= 0
+            source = source[in_subset]
+            target = target[in_subset]
+            squared = ((X[source] - X[target])**2).sum(axis=1)
+            in_radius = squared <= squared_radius
+            source = source[in_radius]
+            indices.append(target[in_radius])
+            distances.append(np.sqrt(squared[in_radius]))
+            indptr[sl.start + 1:sl.stop + 1] = np.bincount(
+                source - sl.start, minlength=sl.stop - sl.start)
+        np.cumsum(indptr, out=indptr)
+        return csr_matrix((np.concatenate(distances),
+                           np.concatenate(indices), indptr),
+                          shape=(n_rows, n_rows))
@@ -3,9 +3,24 @@
 
 """Tests for `snapassist` package."""
 
+import os
+import sys
+import json
+import importlib
+
 import pytest
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import NearestNeighbors
 
+from .. import clustering
 from .. import database
+from .. import mapping
+from .. import querycache
+from .. import querystore
+from .. import spatial
+from .. import tiling
+from ..sklearn_optics import optics
 
 
 @pytest.fixture
@@ -22,3 +37,551 @@ def test_content(response):
     """Sample pytest test function with the pytest fixture as an argument."""
     # from bs4 import BeautifulSoup
     # assert 'GitHub' in BeautifulSoup(response.content).title.string
+
+
+@pytest.fixture
+def photo_tables(tmpdir):
+    """Small main and popular tables written to HDF5."""
+    rs = np.random.RandomState(0)
+    vocab = ['cn', 'tower', 'cntower', 'toronto', 'skyline', 'night', 'art']
+    n = 300
+    mtab = pd.DataFrame({
+        'id': [str(1000 + i) for i in range(n)],
+        'owner': ['owner{0}'.format(i % 17) for i in range(n)],
+        'views': rs.randint(0, 1000, n),
+        'tags': [' '.join(rs.choice(vocab, rs.randint(0, 5)))
+                 for i in range(n)],
+        'longitude': rs.uniform(-79.5, -79.3, n),
+        'latitude': rs.uniform(43.6, 43.7, n),
+        'url_s': ['url{0}'.format(i) for i in range(n)],
+        'width_s': np.full(n, 240),
+        'height_s': np.full(n, 180)},
+        index=np.arange(0, 2 * n, 2))
+    poptab = mtab[mtab['views'] > np.percentile(mtab['views'], 75)].copy()
+    for key, value in (('Camera', 'Canon'), ('Lens', 'N/A'),
+                       ('FocalLength', 35.), ('FocalLengthIn35mmFormat', 35.),
+                       ('FNumber', 8.), ('ExposureTime', 0.01), ('ISO', 100)):
+        poptab[key] = value
+    # Some photos have missing strings.
+    mtab.loc[mtab.index[::50], 'owner'] = np.nan
+    poptab.loc[poptab.index[::3], 'Camera'] = np.nan
+    main_table = str(tmpdir.join('master_table_processed.hdf5'))
+    popular_table = str(tmpdir.join('popular_table_processed.hdf5'))
+    mtab.to_hdf(main_table, key='table')
+    poptab.to_hdf(popular_table, key='table')
+    return mtab, main_table, popular_table
+
+
+@pytest.fixture
+def webapp(photo_tables, monkeypatch):
+    """The web app package, freshly imported to serve `photo_tables`."""
+    monkeypatch.setenv('FLICKR_TABLES_FOLDER',
+                       os.path.dirname(photo_tables[1]) + os.sep)
+    webapp_name = __package__.rsplit('.', 1)[0] + '.webapp'
+    for name in list(sys.modules):
+        if name.startswith(webapp_name):
+            monkeypatch.delitem(sys.modules, name)
+    return importlib.import_module(webapp_name)
+
+
+@pytest.mark.parametrize('phrase', ['CN Tower', 'tower cn', 'cntower',
+                                    'Skyline night!', 'nothing', ''])
+def test_search_tags_matches_scan(photo_tables, phrase):
+    mtab, main_table, popular_table = photo_tables
+    db = database.FlickrPhotosDatabase(main_table, popular_table)
+
+    # Brute-force split-or-joined matching over every row.
+    search_args_split, search_args_joined = database._reduce_phrase(phrase)
+    expected = [i for i, tags in enumerate(mtab['tags'].str.split())
+                if all(item in tags for item in search_args_split) or
+                search_args_joined in tags]
+
+    results = db.get_search_results(phrase)
+    assert list(results.index) == list(mtab.index[expected])
+
+
+@pytest.mark.parametrize('phrase', ['CN Tower', 'skyline', 'nothing'])
+def test_search_results_match_across_load_modes(photo_tables, tmpdir,
+                                                phrase):
+    mtab, main_table, popular_table = photo_tables
+    search_bundle = str(tmpdir.join('search_bundle'))
+    database.build_search_bundle(search_bundle, mtab,
+                                 pd.read_hdf(popular_table, 'table'),
+                                 main_table=main_table,
+                                 popular_table=popular_table)
+    columns = list(database.shared_columns + database.exif_columns)
+
+    expected = database.FlickrPhotosDatabase(
+        main_table, popular_table).get_search_results(phrase)[columns]
+    for mmap in (False, True):
+        db = database.FlickrPhotosDatabase(
+            main_table, popular_table, search_bundle=search_bundle,
+            mmap=mmap)
+        results = db.get_search_results(phrase)[columns]
+        pd.testing.assert_frame_equal(results.astype(object),
+                                      expected.astype(object),
+                                      check_dtype=False)
+
+
+@pytest.mark.parametrize('mmap, record_sources',
+                         [(False, False), (False, True), (True, True)])
+def test_stale_search_bundle_is_rejected(photo_tables, tmpdir, mmap,
+                                         record_sources):
+    mtab, main_table, popular_table = photo_tables
+    search_bundle = str(tmpdir.join('search_bundle'))
+    sources = {'main_table': main_table, 'popular_table': popular_table}
+    database.build_search_bundle(search_bundle, mtab,
+                                 pd.read_hdf(popular_table, 'table'),
+                                 **(sources if record_sources else {}))
+    database.FlickrPhotosDatabase(main_table, popular_table,
+                                  search_bundle=search_bundle, mmap=mmap)
+
+    # Rebuild the main table with the same number of rows, but other photos.
+    rebuilt = mtab.copy()
+    rebuilt.index = rebuilt.index + 1
+    rebuilt.to_hdf(main_table, key='table')
+    with pytest.raises(ValueError):
+        database.FlickrPhotosDatabase(main_table, popular_table,
+                                      search_bundle=search_bundle, mmap=mmap)
+
+
+@pytest.mark.parametrize('n_candidates, n_pairs', [(6, 100), (4, 3)])
+def test_frequent_phrases_matches_brute_force(tmpdir, n_candidates, n_pairs):
+    # Ties in tag and pair counts, tags no other tag appears with (so their
+    # pairs are cut), and repeated tags within a photo.
+    tags = ['a b c', 'a b', 'b c c', 'a c', 'd', 'd', 'e a', 'e b', 'f',
+            'a b c e', 'c e']
+    mtab = pd.DataFrame({'tags': tags, 'views': np.arange(len(tags)),
+                         'longitude': np.zeros(len(tags)),
+                         'latitude': np.zeros(len(tags))})
+    main_table = str(tmpdir.join('main.hdf5'))
+    popular_table = str(tmpdir.join('popular.hdf5'))
+    mtab.to_hdf(main_table, key='table')
+    mtab.iloc[:0].reindex(columns=database.exif_columns).to_hdf(
+        popular_table, key='table')
+    db = database.FlickrPhotosDatabase(main_table, popular_table)
+    phrases = db.frequent_phrases(n_tags=3, n_pairs=n_pairs,
+                                  n_candidates=n_candidates)
+
+    tag_sets = [set(item.split()) for item in tags]
+    vocabulary = sorted(set().union(*tag_sets))
+    counts = {tag: sum(tag in item for item in tag_sets)
+              for tag in vocabulary}
+    by_count = sorted(vocabulary, key=lambda tag: -counts[tag])
+    candidates = by_count[:n_candidates]
+    pairs = [(sum(tag_1 in item and tag_2 in item for item in tag_sets),
+              tag_1 + ' ' + tag_2)
+             for i, tag_1 in enumerate(candidates)
+             for tag_2 in candidates[i + 1:]]
+    pairs = [pair for n_both, pair in
+             sorted(pairs, key=lambda item: -item[0]) if n_both > 0]
+    assert phrases == by_count[:3] + pairs[:n_pairs]
+
+
+def test_query_cache_evicts_least_recently_used():
+    cache = querycache.QueryCache(max_bytes=3 * 800)
+    for key in 'abc':
+        cache.put(key, np.zeros(100))
+    assert cache.get('a') is not None
+    cache.put('d', np.zeros(100))
+    assert cache.get('b') is None
+    assert sorted(cache._entries) == ['a', 'c', 'd']
+    assert cache.nbytes == 3 * 800
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Values larger than the whole cache aren't stored.
+    cache.put('e', np.zeros(1000))
+    assert cache.get('e') is None and len(cache) == 3
+
+
+def test_query_store_round_trip(tmpdir):
+    store = querystore.QueryStore(str(tmpdir.join('store')))
+    assert store.load('cn tower') is None
+    store.save('cn tower', labels=np.arange(5), ids=np.array([0, 3]))
+    assert 'cn tower' in store
+    loaded = store.load('cn tower')
+    assert sorted(loaded) == ['ids', 'labels']
+    assert np.array_equal(loaded['labels'], np.arange(5))
+
+
+def test_query_store_evicts_least_recently_used(tmpdir):
+    store = querystore.QueryStore(str(tmpdir.join('store')))
+    store.save('a', values=np.zeros(1000))
+    entry_bytes = store.nbytes()
+    store.max_bytes = 2 * entry_bytes
+    store.save('b', values=np.zeros(1000))
+    # Make 'a' older than 'b', then use it.
+    os.utime(store._path('a'), (1000, 1000))
+    os.utime(store._path('b'), (2000, 2000))
+    assert store.load('a') is not None
+    store.save('c', values=np.zeros(1000))
+    assert 'a' in store and 'c' in store
+    assert 'b' not in store
+    assert store.nbytes() == 2 * entry_bytes
+
+
+def test_query_store_interleaved_saves(tmpdir, monkeypatch):
+    store = querystore.QueryStore(str(tmpdir.join('store')))
+    replace = os.replace
+
+    def replace_after_other_save(src, dst):
+        # Another writer saves the same key between this one's write and
+        # rename.
+        monkeypatch.setattr(os, 'replace', replace)
+        store.save('cn tower', labels=np.arange(3))
+        replace(src, dst)
+
+    monkeypatch.setattr(os, 'replace', replace_after_other_save)
+    store.save('cn tower', labels=np.arange(5))
+    assert np.array_equal(store.load('cn tower')['labels'], np.arange(5))
+    assert os.listdir(store.folder) == [os.path.basename(
+        store._path('cn tower'))]
+
+    # Failed saves leave nothing behind.
+    def failing_savez(file, **arrays):
+        file.write(b'partial')
+        raise IOError("disk full")
+
+    monkeypatch.setattr(np, 'savez', failing_savez)
+    with pytest.raises(IOError):
+        store.save('cn tower', labels=np.arange(5))
+    assert len(os.listdir(store.folder)) == 1
+
+
+def _textbook_optics_order(X, min_samples, max_eps):
+    """OPTICS ordering with a brute-force seed list, ties broken by index."""
+    distances = np.sqrt(((X[:, None, :] - X[None, :, :])**2).sum(axis=2))
+    core_distances = np.sort(distances, axis=1)[:, min_samples - 1]
+    reachability = np.full(len(X), np.inf)
+    processed = np.zeros(len(X), dtype=bool)
+    ordering = []
+    for point in range(len(X)):
+        while not processed[point]:
+            processed[point] = True
+            ordering.append(point)
+            if core_distances[point] <= max_eps:
+                nbrs = np.flatnonzero((distances[point] <= max_eps) &
+                                      ~processed)
+                reachability[nbrs] = np.minimum(
+                    reachability[nbrs],
+                    np.maximum(distances[point, nbrs], core_distances[point]))
+            seeds = np.flatnonzero(~processed & np.isfinite(reachability))
+            if len(seeds):
+                point = seeds[np.lexsort((seeds, reachability[seeds]))[0]]
+    return np.array(ordering), reachability
+
+
+@pytest.mark.parametrize('precompute_neighbors', [False, True])
+@pytest.mark.parametrize('max_eps', [2., np.inf])
+def test_optics_ordering_matches_textbook(max_eps, precompute_neighbors):
+    # Integer coordinates keep distances exact, so ties are reproducible.
+    X = np.round(np.random.RandomState(0).randn(400, 2) * 8)
+    clust = optics.OPTICS(min_samples=8, max_eps=max_eps,
+                          precompute_neighbors=precompute_neighbors).fit(X)
+    ordering, reachability = _textbook_optics_order(X, 8, max_eps)
+    assert np.array_equal(clust.ordering_, ordering)
+    assert np.allclose(clust.reachability_, reachability)
+
+
+def test_find_local_maxima_matches_scan():
+    rs = np.random.RandomState(0)
+    reachability = rs.randint(0, 5, 300).astype(float)
+    reachability[[0, 50, 120]] = [np.inf, np.nan, np.inf]
+    expected = []
+    for i in range(1, len(reachability) - 1):
+        point = reachability[i]
+        neighborhood = np.r_[reachability[max(1, i - 4):i],
+                             reachability[i + 1:i + 4]]
+        if (point > reachability[i - 1] and point >= reachability[i + 1] and
+                np.all(point >= neighborhood)):
+            expected.append(i)
+    expected.sort(key=lambda i: -reachability[i])
+    assert optics._find_local_maxima(reachability, 3) == expected
+
+
+def test_extract_optics_deep_cluster_tree():
+    # Each split leaves all remaining maxima on one side, nesting the tree
+    # deeper than the default recursion limit.
+    n_peaks = 1500
+    reachability = np.tile([1., 2., 1.], n_peaks) * np.linspace(.5, 1.,
+                                                                3 * n_peaks)
+    reachability[0] = np.inf
+    labels = optics._extract_optics(np.arange(3 * n_peaks), reachability,
+                                    maxima_ratio=1., min_cluster_size=2,
+                                    min_maxima_ratio=0)[1]
+    assert labels.max() == n_peaks - 2
+
+
+def test_optics_reextraction_matches_refit():
+    rs = np.random.RandomState(0)
+    X = np.vstack([rs.randn(150, 2) * 0.2 + center
+                   for center in [(0, 0), (2, 2), (0, 3)]])
+    clust = optics.OPTICS(min_samples=10).fit(X)
+    refit = optics.OPTICS(min_samples=10, min_cluster_size=.4).fit(X)
+    core_samples, labels = clust.extract_optics(min_cluster_size=.4)
+    assert labels.max() < clust.labels_.max()
+    assert np.array_equal(labels, refit.labels_)
+    assert np.array_equal(core_samples, refit.core_sample_indices_)
+    assert np.array_equal(clust.extract_optics()[1], clust.labels_)
+
+
+def test_spatial_index_matches_subset_tree():
+    rs = np.random.RandomState(0)
+    longlat = np.vstack([rs.randn(2000, 2) * 0.01 + (-79.4, 43.7),
+                         rs.randn(1000, 2) * 0.05 + (-79.3, 43.6)])
+    index = spatial.SpatialIndex(longlat)
+    rows = np.sort(rs.choice(len(longlat), 600, replace=False))
+    scale = np.array([0.7 / 0.05, 1. / 0.03])
+    X = (longlat[rows] - longlat[rows].mean(axis=0)) * scale
+
+    graph = index.radius_neighbors_graph(rows, X, scale, 2.)
+    expected = NearestNeighbors(algorithm='ball_tree').fit(X)
+    expected = expected.radius_neighbors_graph(X, 2., mode='distance')
+    assert np.array_equal(np.diff(graph.indptr), np.diff(expected.indptr))
+    assert abs(graph - expected).max() == 0
+
+    clust = optics.OPTICS(min_samples=10, max_eps=2.)
+    clust.fit(X, neighbors_graph=graph)
+    refit = optics.OPTICS(min_samples=10, max_eps=2.,
+                          precompute_neighbors=True).fit(X)
+    assert np.array_equal(clust.ordering_, refit.ordering_)
+    assert np.array_equal(clust.labels_, refit.labels_)
+    is_core = refit.core_distances_ <= 2.
+    assert np.array_equal(clust.core_distances_[is_core],
+                          refit.core_distances_[is_core])
+
+
+def test_cluster_search_results_precomputes_neighbors(webapp, monkeypatch):
+    graphs = []
+    calculate_optics_order = optics.OPTICS._calculate_optics_order
+
+    def record_graph(self, X, nbrs, graph=None):
+        graphs.append(graph)
+        return calculate_optics_order(self, X, nbrs, graph)
+
+    monkeypatch.setattr(optics.OPTICS, '_calculate_optics_order',
+                        record_graph)
+    positions = webapp.db.search_tags('tower')
+    results = webapp.db.take_search_results(positions)
+    assert len(results) > 50
+    # As in a large corpus, the whole index holds far more candidates than
+    # the results' own graph.
+    monkeypatch.setattr(webapp.views, 'global_max_graph_size',
+                        len(results)**2)
+    labels, ids, centroids = webapp.views.cluster_search_results(
+        results, positions=positions)
+    assert len(graphs) == 1 and graphs[0] is not None
+    assert len(labels) == len(results)
+
+
+@pytest.mark.parametrize('search_term', ['!!', ' ', '?-'])
+def test_punctuation_only_search_finds_nothing(webapp, search_term):
+    assert webapp.views.get_search_results(search_term)[0] is None
+    assert webapp.views.compute_clusters(search_term)[1] is None
+    response = webapp.app.test_client().get(
+        '/output', query_string={'search_keywords': search_term})
+    assert response.status_code == 200
+    assert b'find anything with those keywords' in response.data
+
+
+def test_grid_clustering_finds_dense_regions():
+    rs = np.random.RandomState(0)
+    longlat = np.vstack([rs.randn(3000, 2) * 0.003 + (-79.39, 43.65),
+                         rs.randn(3000, 2) * 0.003 + (-79.30, 43.70),
+                         rs.uniform((-79.5, 43.6), (-79.2, 43.8), (600, 2))])
+    table = pd.DataFrame({'longitude': longlat[:, 0],
+                          'latitude': longlat[:, 1],
+                          'views': np.ones(len(longlat))})
+    clst = clustering.Clustering(table, database.TorontoLongLat())
+    clst.optics_clustering(grid_threshold=5000)
+    assert clst.optics_ is None
+    labels = table['cluster'].values
+    assert labels.max() == 1
+    for blob in (labels[:3000], labels[3000:6000]):
+        assert np.mean(blob == np.bincount(blob[blob >= 0]).argmax()) > 0.9
+
+
+def test_clustering_reextraction():
+    rs = np.random.RandomState(0)
+    longlat = np.vstack([rs.randn(150, 2) * 0.002 + center
+                         for center in [(-79.39, 43.65), (-79.35, 43.67),
+                                        (-79.42, 43.70)]])
+    table = pd.DataFrame({'longitude': longlat[:, 0],
+                          'latitude': longlat[:, 1]})
+    clst = clustering.Clustering(table, database.TorontoLongLat())
+    for reextract in (clst.reextract_optics_clusters,
+                      lambda: clst.reextract_dbscan_clusters(0.1)):
+        with pytest.raises(ValueError):
+            reextract()
+
+    clst.optics_clustering()
+    fit = clst.optics_
+    labels = table['cluster'].values.copy()
+    assert labels.max() >= 1
+    clst.reextract_optics_clusters(maxima_ratio=fit.maxima_ratio,
+                                   rejection_ratio=fit.rejection_ratio,
+                                   min_cluster_size=fit.min_cluster_size)
+    assert np.array_equal(table['cluster'], fit.labels_)
+    assert np.array_equal(table['cluster'], labels)
+
+    eps = fit.max_eps / 10.
+    clst.reextract_dbscan_clusters(eps)
+    assert np.array_equal(table['cluster'], fit.extract_dbscan(eps)[1])
+    assert table['cluster'].max() >= 1
+
+    # Grid clustering leaves no OPTICS fit to re-extract from.
+    clst.grid_clustering()
+    with pytest.raises(ValueError):
+        clst.reextract_optics_clusters()
+
+
+def test_trim_and_get_centroids():
+    rs = np.random.RandomState(0)
+    longlat = np.vstack([rs.randn(50, 2) * 0.001 + (-79.39, 43.65),
+                         [(-79.30, 43.65)],
+                         rs.randn(50, 2) * 0.001 + (-79.35, 43.70)])
+    table = pd.DataFrame({'longitude': longlat[:, 0],
+                          'latitude': longlat[:, 1],
+                          'views': np.r_[np.full(51, 500), np.full(50, 5)],
+                          'cluster': np.r_[np.zeros(51, int),
+                                           np.ones(50, int)]},
+                         index=np.arange(101) + 1000)
+    table.loc[1005, 'cluster'] = -1
+    clst = clustering.Clustering(table, database.TorontoLongLat())
+    outliers, ids, centroids = clst.trim_and_get_centroids(
+        critical_views=100)
+    # The stray photo in cluster 0 and all of unpopular cluster 1 are cut.
+    assert np.array_equal(outliers, np.r_[1050, np.arange(1051, 1101)])
+    assert ids == [0]
+    kept = table.loc[table.index[:50].drop(1005)]
+    assert np.allclose(centroids[0],
+                       kept[['longitude', 'latitude']].mean().values)
+
+
+def test_cluster_info_matches_per_cluster_filter():
+    rs = np.random.RandomState(0)
+    table = pd.DataFrame({'cluster': rs.randint(-1, 6, 500),
+                          'views': rs.randint(0, 10000, 500)},
+                         index=rs.choice(10**6, 500, replace=False))
+    ids = [4, 0, 2, 5]
+    info = mapping.ClusterInfo(table, ids, [(i, i) for i in ids])
+    assert list(info.clusters) == ids
+    for i, cluster in info.clusters.items():
+        members = table[table['cluster'] == i]
+        assert cluster.n_photos == len(members)
+        assert cluster.avg_views == members['views'].median()
+        assert cluster.best_photos.equals(
+            members.sort_values('views', ascending=False,
+                                kind='mergesort').iloc[:5])
+    assert sorted(c.rank for c in info.clusters.values()) == [1, 2, 3, 4]
+
+
+def test_photo_point_layer():
+    rs = np.random.RandomState(0)
+    results = pd.DataFrame({'latitude': 43.65 + rs.rand(300) * 0.01,
+                            'longitude': -79.39 + rs.rand(300) * 0.01,
+                            'cluster': rs.randint(-1, 3, 300),
+                            'views': rs.randint(0, 100, 300),
+                            'id': np.arange(300), 'owner': 'someone',
+                            'url_s': 'https://example.com/</script>'})
+    info = mapping.ClusterInfo(results, [0, 1, 2], [(-79.39, 43.65)] * 3)
+    layer = mapping.PhotoPointLayer(results, info)
+    data = json.loads(layer.data)
+    assert data['cluster'] == results['cluster'].tolist()
+    assert data['ranks'] == {str(i): c.rank for i, c in info.clusters.items()}
+    assert '</' not in layer.data
+    with pytest.raises(ValueError):
+        mapping.make_map(results, info, database.TorontoLongLat(),
+                         points='pins')
+
+
+def test_point_hierarchy():
+    rs = np.random.RandomState(0)
+    longitude = np.r_[-79.39 + rs.randn(200) * 1e-4, -79.30 + rs.rand(50)]
+    latitude = np.r_[43.65 + rs.randn(200) * 1e-4, 43.60 + rs.rand(50)]
+    labels = np.r_[np.zeros(150, int), np.ones(50, int), -np.ones(50, int)]
+    hierarchy = tiling.PointHierarchy(longitude, latitude, labels)
+    bbox = (-180., -85., 180., 85.)
+    for zoom in range(hierarchy.max_zoom + 2):
+        clusters = hierarchy.get_clusters(bbox, zoom)
+        assert clusters['count'].sum() == 250
+    # At low zoom, the dense blob is one aggregate with its majority label.
+    clusters = hierarchy.get_clusters(bbox, 10)
+    blob = clusters['count'] >= 200
+    assert blob.sum() == 1
+    assert clusters['cluster'][blob] == 0
+    assert np.isclose(clusters['longitude'][blob], longitude[:200].mean())
+    # Beyond the maximum zoom, the points themselves are returned.
+    clusters = hierarchy.get_clusters(bbox, 20)
+    assert np.array_equal(clusters['row'], np.arange(250))
+    assert np.allclose(clusters['latitude'], latitude)
+
+
+def test_point_hierarchy_tiles():
+    rs = np.random.RandomState(0)
+    longitude = -79.39 + rs.randn(1000) * 0.05
+    latitude = 43.65 + rs.randn(1000) * 0.05
+    hierarchy = tiling.PointHierarchy(longitude, latitude,
+                                      rs.randint(-1, 3, 1000))
+    x, y = tiling.lnglat_to_world(longitude, latitude)
+    for zoom in (0, 12, 20):
+        # Unbuffered tiles partition the aggregates.
+        tiles = set(zip((x * 2**zoom).astype(int), (y * 2**zoom).astype(int)))
+        n_photos = 0
+        for tile_x, tile_y in tiles:
+            tile = hierarchy.get_tile(zoom, tile_x, tile_y, buffer=0)
+            decoded = tiling.decode_tile(tiling.encode_tile(tile))
+            for name, dtype in tiling.tile_columns:
+                assert np.array_equal(decoded[name], tile[name])
+            n_photos += decoded['count'].sum()
+        assert n_photos == 1000
+
+
+def test_cluster_records_fill_popup_templates():
+    rs = np.random.RandomState(0)
+    results = pd.DataFrame({'cluster': rs.randint(0, 2, 20),
+                            'views': rs.randint(0, 100, 20),
+                            'id': np.arange(20), 'owner': 'someone',
+                            'url_s': 'https://example.com/a.jpg',
+                            'width_s': 240,
+                            'height_s': rs.randint(100, 300, 20),
+                            'Camera': 'N/A', 'Lens': 'Some lens',
+                            'FocalLength': rs.rand(20) * 50,
+                            'ExposureTime': rs.rand(20) * 2,
+                            'FNumber': 2.8, 'ISO': 400.})
+    info = mapping.ClusterInfo(results, [0, 1], [(-79.39, 43.65)] * 2)
+    for i in info.clusters:
+        record = info.get_cluster_record(i)
+        elements = ''.join(
+            mapping.best_photo_html_element.format(
+                active=(' active' if j == 0 else ''), **photo) + '\n'
+            for j, photo in enumerate(record['photos']))
+        html = mapping.best_photo_html_tail.format(
+            carousel_id='myCarousel', carousel_elements=elements, **record)
+        assert (info.get_cluster_infographic(i)[1] ==
+                mapping.best_photo_html_head + '\n' + html)
+
+
+def test_format_exif():
+    table = pd.DataFrame({'Camera': ['Nikon D750', 'N/A', np.nan],
+                          'Lens': [np.nan, 'EF24-105mm', 'N/A'],
+                          'FocalLength': [105.5, -1., np.nan],
+                          'ExposureTime': [2.5, 0.004, -1.],
+                          'FNumber': [8., 2.85, -1.],
+                          'ISO': [100., -1., 6400.]}, index=[3, 1, 2])
+    formatted = mapping.format_exif(table)
+    assert list(formatted.columns) == list(database.formatted_exif_columns)
+    assert list(formatted.index) == [3, 1, 2]
+    assert formatted.values.tolist() == [
+        ['Nikon D750', '', '105 mm', '2 s', 'f/8.0', '100'],
+        ['', 'EF24-105mm', '', '1/250 s', 'f/2.9', ''],
+        ['', '', '', '', '', '6400']]
+
+
+def test_get_cluster_colors():
+    labels = np.array([-1, 0, 3, 11, 12, 27, -1])
+    colors = mapping.get_cluster_colors(labels)
+    assert colors.tolist() == [mapping.ClusterInfo.get_cluster_color(label)
+                               for label in labels]
+    assert colors.tolist() == ['#777777', '#a6cee3', '#33a02c', '#b15928',
+                               '#a6cee3', '#33a02c', '#777777']
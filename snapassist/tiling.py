@@ -0,0 +1,237 @@
+import numpy as np
+
+
+# Binary tile layout (see `encode_tile`): column dtypes, in order.  Every
+# column starts at a multiple of its itemsize, so clients can view them as
+# typed arrays without copying.
+tile_columns = (('count', '<u4'), ('cluster', '<i4'), ('row', '<u4'),
+                ('x', '<i2'), ('y', '<i2'))
+
+
+def lnglat_to_world(longitude, latitude):
+    """Web Mercator coordinates, scaled so the world spans [0, 1] in x and y.
+
+    y increases southward, as in map tiles.
+    """
+    x = np.asarray(longitude, dtype=np.float64) / 360. + 0.5
+    sin_lat = np.sin(np.radians(latitude))
+    with np.errstate(divide='ignore'):
+        y = 0.5 - 0.25 * np.log((1. + sin_lat) / (1. - sin_lat)) / np.pi
+    return x, np.clip(y, 0., 1.)
+
+
+def world_to_lnglat(x, y):
+    """Inverse of `lnglat_to_world`."""
+    longitude = (np.asarray(x, dtype=np.float64) - 0.5) * 360.
+    latitude = np.degrees(np.arctan(np.sinh(np.pi * (1. - 2. * y))))
+    return longitude, latitude
+
+
+class PointHierarchy:
+    """Zoom-dependent aggregates of points, for drawing large results.
+
+    Similar to the supercluster JavaScript library, but aggregates on grids
+    rather than greedily, which can be done with a few vectorized passes.  At
+    zoom `z`, points are grouped into square cells `radius` pixels across
+    (for tiles `extent` pixels across), and each cell is drawn as a single
+    point at the mean position of its members.  Cells halve in size with
+    each zoom, so every zoom's aggregates are merged from those of the next.
+    Beyond `max_zoom`, the points themselves are returned.
+
+    Parameters
+    ----------
+    longitude, latitude : numpy.ndarray
+        Long/lat of each point.
+    labels : numpy.ndarray
+        Cluster label of each point, with -1 for background points.
+    radius : float, optional
+        Cell width, in pixels.  Default: 40.
+    extent : int, optional
+        Tile width, in pixels.  Default: 256.
+    min_zoom, max_zoom : int, optional
+        Range of zooms to aggregate over.  Defaults: 0 and 16.
+
+    Attributes
+    ----------
+    levels : dict
+        For each zoom from `min_zoom` to ``max_zoom + 1``, a dict of arrays
+        with the world coordinates ('x', 'y'), number of points ('count'),
+        label ('cluster') and a member's position in the input ('row') of
+        each aggregate.  An aggregate's label is the most common label of its
+        non-background points (the smallest on ties), or -1 if all its
+        points are background.
+    """
+
+    def __init__(self, longitude, latitude, labels, radius=40., extent=256,
+                 min_zoom=0, max_zoom=16):
+        self.radius = radius
+        self.extent = extent
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+
+        x, y = lnglat_to_world(longitude, latitude)
+        labels = np.asarray(labels, dtype=np.int64)
+        n_points = len(labels)
+        rows = np.arange(n_points)
+        self.levels = {max_zoom + 1: {
+            'x': x, 'y': y, 'count': np.ones(n_points, dtype=np.int64),
+            'cluster': labels, 'row': rows}}
+
+        # Cells of max_zoom.  Index i of a cell at zoom z is in cell i >> 1
+        # at zoom z - 1.
+        n_cells = int(np.ceil(extent * 2**max_zoom / radius))
+        ix = np.minimum((x * n_cells).astype(np.int64), n_cells - 1)
+        iy = np.minimum((y * n_cells).astype(np.int64), n_cells - 1)
+        count = self.levels[max_zoom + 1]['count']
+        sum_x = x
+        sum_y = y
+        # Number of points of each label in each cell, as (cell, label,
+        # count) triples.
+        label_cell = rows
+        label_value = labels
+        label_count = count
+        n_labels = labels.max() + 2 if n_points else 1
+
+        for zoom in range(max_zoom, min_zoom - 1, -1):
+            _, first, inverse = np.unique(ix * n_cells + iy,
+                                          return_index=True,
+                                          return_inverse=True)
+            inverse = inverse.ravel()
+            n_aggregates = len(first)
+            count = np.bincount(inverse, weights=count,
+                                minlength=n_aggregates).astype(np.int64)
+            sum_x = np.bincount(inverse, weights=sum_x,
+                                minlength=n_aggregates)
+            sum_y = np.bincount(inverse, weights=sum_y,
+                                minlength=n_aggregates)
+            rows = rows[first]
+            ix = ix[first]
+            iy = iy[first]
+
+            label_cell = inverse[label_cell]
+            label_key = label_cell * n_labels + label_value + 1
+            _, label_first, label_inverse = np.unique(
+                label_key, return_index=True, return_inverse=True)
+            label_count = np.bincount(label_inverse.ravel(),
+                                      weights=label_count).astype(np.int64)
+            label_cell = label_cell[label_first]
+            label_value = label_value[label_first]
+
+            self.levels[zoom] = {
+                'x': sum_x / count, 'y': sum_y / count, 'count': count,
+                'cluster': self._dominant_labels(
+                    n_aggregates, label_cell, label_value, label_count),
+                'row': rows}
+
+            ix >>= 1
+            iy >>= 1
+            n_cells = (n_cells + 1) // 2
+
+    @staticmethod
+    def _dominant_labels(n_aggregates, label_cell, label_value, label_count):
+        dominant = np.full(n_aggregates, -1, dtype=np.int64)
+        clustered = label_value >= 0
+        label_cell = label_cell[clustered]
+        label_value = label_value[clustered]
+        # Sort by cell, then by descending count, then by label, and take the
+        # first of each cell.
+        order = np.lexsort((label_value, -label_count[clustered],
+                            label_cell))
+        label_cell = label_cell[order]
+        first = np.r_[True, label_cell[1:] != label_cell[:-1]]
+        dominant[label_cell[first]] = label_value[order][first]
+        return dominant
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for level in self.levels.values()
+                   for array in level.values())
+
+    def get_clusters(self, bbox, zoom):
+        """Aggregates within a bounding box at a zoom.
+
+        Parameters
+        ----------
+        bbox : tuple
+            (west, south, east, north) bounds, in degrees.  Boxes crossing
+            the antimeridian are not supported.
+        zoom : int
+            Map zoom.  Zooms beyond `max_zoom` return the points themselves,
+            and zooms below `min_zoom` the aggregates of `min_zoom`.
+
+        Returns
+        -------
+        clusters : dict
+            Arrays of the long/lat ('longitude', 'latitude'), 'count',
+            'cluster' and 'row' of each aggregate in `bbox` (see `levels`).
+        """
+        zoom = int(min(max(zoom, self.min_zoom), self.max_zoom + 1))
+        level = self.levels[zoom]
+        west, south, east, north = bbox
+        (x_min, x_max), (y_max, y_min) = lnglat_to_world(
+            [west, east], [south, north])
+        in_bbox = ((level['x'] >= x_min) & (level['x'] <= x_max) &
+                   (level['y'] >= y_min) & (level['y'] <= y_max))
+        longitude, latitude = world_to_lnglat(level['x'][in_bbox],
+                                              level['y'][in_bbox])
+        return {'longitude': longitude, 'latitude': latitude,
+                'count': level['count'][in_bbox],
+                'cluster': level['cluster'][in_bbox],
+                'row': level['row'][in_bbox]}
+
+    def get_tile(self, z, x, y, extent=4096, buffer=256):
+        """Aggregates in map tile `z`/`x`/`y`.
+
+        Parameters
+        ----------
+        z, x, y : int
+            Tile zoom and column/row.
+        extent : int, optional
+            Tile width, in tile coordinates.  Default: 4096.
+        buffer : int, optional
+            Aggregates up to this far outside the tile, in tile coordinates,
+            are included, so markers straddling tile edges are drawn whole.
+            Default: 256.
+
+        Returns
+        -------
+        tile : dict
+            Arrays of the 'count', 'cluster' and 'row' of each aggregate (see
+            `levels`), and its position within the tile ('x', 'y'), in tile
+            coordinates.
+        """
+        level = self.levels[int(min(max(z, self.min_zoom),
+                                    self.max_zoom + 1))]
+        tile_x = (level['x'] * 2**z - x) * extent
+        tile_y = (level['y'] * 2**z - y) * extent
+        in_tile = ((tile_x >= -buffer) & (tile_x < extent + buffer) &
+                   (tile_y >= -buffer) & (tile_y < extent + buffer))
+        return {'count': level['count'][in_tile],
+                'cluster': level['cluster'][in_tile],
+                'row': level['row'][in_tile],
+                'x': np.round(tile_x[in_tile]),
+                'y': np.round(tile_y[in_tile])}
+
+
+def encode_tile(tile):
+    """Encode the output of `PointHierarchy.get_tile` as compact bytes.
+
+    The number of aggregates ``n`` as a little-endian uint32, followed by the
+    ``n`` values of each of `tile_columns` in turn.
+    """
+    n_points = len(tile['count'])
+    return b''.join([np.array([n_points], dtype='<u4').tobytes()] +
+                    [np.asarray(tile[name]).astype(dtype).tobytes()
+                     for name, dtype in tile_columns])
+
+
+def decode_tile(data):
+    """Inverse of `encode_tile`."""
+    n_points = int(np.frombuffer(data, dtype='<u4', count=1)[0])
+    tile = {}
+    offset = 4
+    for name, dtype in tile_columns:
+        tile[name] = np.frombuffer(data, dtype=dtype, count=n_points,
+                                   offset=offset)
+        offset += tile[name].nbytes
+    return tile
@@ -7,6 +7,9 @@ __version__ = '0.1.0'
 from flask import Flask
 import os
 from .. import database
+from .. import querycache
+from .. import querystore
+from .. import spatial
 
 
 # Do `export FLICKR_TABLE_FOLDER=XXXXXX`. in the same command prompt before
@@ -16,15 +19,63 @@ flickr_tables_main = os.path.join(FLICKR_TABLES_FOLDER +
                                   'master_table_processed.hdf5')
 flickr_tables_popular = os.path.join(FLICKR_TABLES_FOLDER +
                                      'popular_table_processed.hdf5')
+# Search artifacts precomputed by `read_and_preprocess_tables`, if available.
+flickr_search_bundle = os.path.join(FLICKR_TABLES_FOLDER + 'search_bundle')
+# Clusters precomputed by `run_precompute_clusters.py`.
+flickr_precomputed_clusters = os.path.join(FLICKR_TABLES_FOLDER +
+                                           'precomputed_clusters')
+# OPTICS reachability plots of past queries.
+flickr_reachability = os.path.join(FLICKR_TABLES_FOLDER + 'reachability')
 
 # Launch app.
 app = Flask(__name__)
 
-db = database.FlickrPhotosDatabase(flickr_tables_main, flickr_tables_popular)
+db = database.FlickrPhotosDatabase(
+    flickr_tables_main, flickr_tables_popular,
+    search_bundle=(flickr_search_bundle
+                   if os.path.isdir(flickr_search_bundle) else None),
+    mmap=True)
 toronto_longlat = database.TorontoLongLat()
+# Search results with at most `global_max_graph_size` pairs of photos are
+# clustered from a neighbors graph built on the results.  Larger ones find
+# neighbors with this spatial index of all photos if that is estimated to
+# need at most `global_max_graph_size` candidate pairs, or else query a
+# per-query tree point by point.  The index's tree is only built once a query
+# uses it.
+spatial_index = spatial.SpatialIndex(db.mtab_longlat)
+global_max_graph_size = 10**7
 global_min_samples = 15
 global_max_eps_scaling = 1.
+# Search results with more photos than this are clustered on a grid rather
+# than with OPTICS.
+global_grid_threshold = 50000
+# Search results with more photos than this are mapped with level-of-detail
+# aggregates fetched from `/tiles`, rather than embedding every photo.
+global_lod_threshold = 20000
 master_sigma_cut = 2.5
+global_critical_char_dist = 0.05
+
+# Query result caches, keyed by canonical search phrase.  Search results,
+# cluster labels and rendered map HTML are each given a quarter of the memory
+# cap, and level-of-detail point hierarchies and their encoded tiles an
+# eighth each.  Set `SNAPASSIST_CACHE_BYTES` to change the cap.
+query_cache_max_bytes = int(os.environ.get('SNAPASSIST_CACHE_BYTES') or
+                            256 * 2**20)
+search_cache = querycache.QueryCache(max_bytes=query_cache_max_bytes // 4)
+cluster_cache = querycache.QueryCache(max_bytes=query_cache_max_bytes // 4)
+precomputed_clusters = querystore.QueryStore(flickr_precomputed_clusters)
+map_cache = querycache.QueryCache(max_bytes=query_cache_max_bytes // 4,
+                                  ttl=24 * 3600)
+lod_cache = querycache.QueryCache(max_bytes=query_cache_max_bytes // 8)
+# Keyed by (canonical search phrase, z, x, y).
+tile_cache = querycache.QueryCache(max_bytes=query_cache_max_bytes // 8)
+# On-disk store of OPTICS fits, so queries that miss the caches above only
+# need cluster extraction.  Set `SNAPASSIST_REACHABILITY_BYTES` to change its
+# size budget.
+reachability_store = querystore.QueryStore(
+    flickr_reachability,
+    max_bytes=int(os.environ.get('SNAPASSIST_REACHABILITY_BYTES') or
+                  2**30))
 
 
 # Circular import, so needs to be defined after `app` is.
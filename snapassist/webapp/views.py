@@ -2,10 +2,17 @@ import flask
 import re
 from . import app
 from . import db
+import numpy as np
 from . import (toronto_longlat, global_min_samples, master_sigma_cut,
-               global_max_eps_scaling)
+               global_max_eps_scaling, spatial_index, global_max_graph_size,
+               global_grid_threshold, global_lod_threshold,
+               global_critical_char_dist)
+from . import (search_cache, cluster_cache, map_cache, lod_cache,
+               tile_cache, precomputed_clusters, reachability_store)
 from .. import clustering
+from .. import database
 from .. import mapping
+from .. import tiling
 
 
 bad_css = (r'    <link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/'
@@ -19,32 +26,268 @@ def input_page():
     return flask.render_template("input.html", err_message="")
 
 
-def get_search_results(search_term):
+def _reachability_key(key):
+    # OPTICS fits depend on the clustering parameters as well as the query.
+    return '{0} (min_samples={1}, max_eps_scaling={2})'.format(
+        key, global_min_samples, global_max_eps_scaling)
 
-    results = db.get_search_results(search_term)
 
-    if (len(results) < global_min_samples) or (
-            results['views'].max() < db.mtab_75percentile_views):
-        return None
+def _precomputed_key(key):
+    # Trimmed clusters also depend on the trimming and grid parameters.
+    return ('{0} (min_samples={1}, max_eps_scaling={2}, sigma_cut={3}, '
+            'grid_threshold={4}, critical_char_dist={5})'.format(
+                key, global_min_samples, global_max_eps_scaling,
+                master_sigma_cut, global_grid_threshold,
+                global_critical_char_dist))
+
 
+def cluster_search_results(results, key=None, positions=None):
+    """Cluster search results and trim outliers.
+
+    Parameters
+    ----------
+    results : pandas.DataFrame
+        Search results.
+    key : str, optional
+        Canonical search phrase of `results`.  If given, the OPTICS fit is
+        loaded from `reachability_store` if available, and saved to it if
+        not.
+    positions : numpy.ndarray, optional
+        Main table positions of `results`.  If given, neighbors of results
+        too large for their own neighbors graph may be found using
+        `spatial_index`.
+
+    Returns
+    -------
+    labels : numpy.ndarray
+        Cluster label of each row of `results`, with outliers set to -1.
+    ids : list
+        IDs of clusters that survived trimming.
+    centroids : list
+        Corresponding cluster centroids.
+    """
     # Clustering (results is implicitly being altered by clst).
     clst = clustering.Clustering(results, toronto_longlat,
                                  global_min_samples=global_min_samples)
-    clst.optics_clustering(max_eps_scaling=global_max_eps_scaling)
+    fit = None
+    if key is not None:
+        fit = reachability_store.load(_reachability_key(key))
+        if fit is not None and len(fit['ordering']) != len(results):
+            fit = None
+    clst.optics_clustering(
+        max_eps_scaling=global_max_eps_scaling, fit=fit,
+        spatial_index=(spatial_index if positions is not None else None),
+        rows=positions, max_graph_size=global_max_graph_size,
+        grid_threshold=global_grid_threshold)
+    if key is not None and fit is None and clst.optics_ is not None:
+        reachability_store.save(_reachability_key(key),
+                                **clst.get_optics_fit())
 
     # Find cluster outliers and shift them to noise.  For efficiency,
     # simultaneous obtain centroids and remove any clusters that don't have a
     # top 25% popular photo within them.
     outlier_indices, ids, centroids = clst.trim_and_get_centroids(
         sigma=master_sigma_cut, critical_views=db.mtab_75percentile_views,
-        critical_char_dist=0.05)
+        critical_char_dist=global_critical_char_dist)
     results.loc[outlier_indices, 'cluster'] = -1
+    return results['cluster'].values, ids, centroids
+
+
+def _is_mappable(results):
+    return not ((len(results) < global_min_samples) or (
+        results['views'].max() < db.mtab_75percentile_views))
+
+
+def _load_precomputed_clusters(key, n_results):
+    precomputed = precomputed_clusters.load(_precomputed_key(key))
+    if precomputed is None or len(precomputed['labels']) != n_results:
+        return None
+    return (precomputed['labels'], list(precomputed['ids']),
+            [tuple(centroid) for centroid in precomputed['centroids']])
+
+
+def save_precomputed_clusters(key, clusters):
+    """Store the output of `compute_clusters` in `precomputed_clusters`,
+    keyed on the clustering parameters as well as `key`."""
+    labels, ids, centroids = clusters
+    precomputed_clusters.save(_precomputed_key(key), labels=labels, ids=ids,
+                              centroids=centroids)
+
+
+def compute_clusters(search_term):
+    """Search for and cluster photos from scratch, bypassing all caches.
+
+    Used by `run_precompute_clusters.py` (in a process pool, hence the key
+    being returned).
+
+    Returns
+    -------
+    key : str
+        Canonical search phrase.
+    clusters : tuple or None
+        Output of `cluster_search_results`, or `None` if the phrase has no
+        search terms or the results aren't worth mapping.
+    """
+    key = database.canonical_phrase(search_term)
+    if not key:
+        return key, None
+    positions = db.search_tags(key)
+    results = db.take_search_results(positions)
+    if not _is_mappable(results):
+        return key, None
+    return key, cluster_search_results(results, key=key, positions=positions)
+
+
+def get_search_results(search_term):
+    """Search for and cluster photos, using cached results where possible.
+
+    Returns
+    -------
+    results : pandas.DataFrame or None
+        Search results, with cluster labels in the 'cluster' column, or
+        `None` if the phrase has no search terms (eg. is only punctuation),
+        or too few (or no popular enough) photos were found.
+    ids : list
+        IDs of clusters.
+    centroids : list
+        Corresponding cluster centroids.
+    """
+    key = database.canonical_phrase(search_term)
+    # An empty phrase would match every photo.
+    if not key:
+        return None, [], []
+
+    positions = search_cache.get(key)
+    if positions is None:
+        positions = db.search_tags(key)
+        search_cache.put(key, positions)
+    results = db.take_search_results(positions)
+
+    if not _is_mappable(results):
+        return None, [], []
+
+    clusters = cluster_cache.get(key)
+    if clusters is None:
+        clusters = _load_precomputed_clusters(key, len(results))
+        if clusters is None:
+            clusters = cluster_search_results(results, key=key,
+                                              positions=positions)
+        cluster_cache.put(key, clusters)
+    labels, ids, centroids = clusters
+    results['cluster'] = labels
+    return results, ids, centroids
+
+
+def _tiles_url(key):
+    # Template of tile URLs, for Leaflet.  url_for would escape the braces.
+    url = flask.url_for('tiles_page', search_term=key, z=0, x=0, y=0)
+    return url[:-len('0/0/0')] + '{z}/{x}/{y}'
+
+
+def get_map_html(search_term):
+    """Rendered map of clustered search results, or `None` if there are no
+    results worth mapping."""
+    key = database.canonical_phrase(search_term)
+    map_TO_render = map_cache.get(key)
+    if map_TO_render is not None:
+        return map_TO_render
+
+    results, ids, centroids = get_search_results(search_term)
+    if results is None:
+        return None
 
     # Get cluster details to prepare for mapping.
     cluster_info = mapping.ClusterInfo(results, ids, centroids)
 
-    map_TO = mapping.make_map(results, cluster_info, toronto_longlat)
-    return map_TO.get_root()
+    if len(results) > global_lod_threshold:
+        map_TO = mapping.make_map(
+            results, cluster_info, toronto_longlat, points='tiles',
+            points_url=flask.url_for('points_page', search_term=key),
+            tiles_url=_tiles_url(key))
+    else:
+        map_TO = mapping.make_map(results, cluster_info, toronto_longlat)
+    map_TO_render = map_TO.get_root().render()
+    # Hack to remove adding redundant bootstrap CSS files.
+    map_TO_render = re.sub(bad_css, '', map_TO_render)
+    map_cache.put(key, map_TO_render)
+    return map_TO_render
+
+
+def get_point_hierarchy(search_term):
+    """Level-of-detail aggregates of clustered search results, and the
+    columns needed for popups of single photos, or `None` if there are no
+    results worth mapping."""
+    key = database.canonical_phrase(search_term)
+    lod = lod_cache.get(key)
+    if lod is not None:
+        return lod
+
+    results, ids, centroids = get_search_results(search_term)
+    if results is None:
+        return None
+
+    hierarchy = tiling.PointHierarchy(results['longitude'].values,
+                                      results['latitude'].values,
+                                      results['cluster'].values)
+    lod = (hierarchy, results[['id', 'owner', 'url_s']].copy())
+    lod_cache.put(key, lod)
+    return lod
+
+
+@app.route('/points/<search_term>')
+def points_page(search_term):
+    """Aggregates of search results within the bounding box `bbox`
+    (west,south,east,north) at zoom `z`, as JSON."""
+    try:
+        zoom = int(flask.request.args['z'])
+        bbox = [float(edge) for edge in flask.request.args['bbox'].split(',')]
+    except (KeyError, ValueError):
+        flask.abort(400)
+    if len(bbox) != 4:
+        flask.abort(400)
+    lod = get_point_hierarchy(search_term)
+    if lod is None:
+        flask.abort(404)
+    hierarchy, photos = lod
+
+    clusters = hierarchy.get_clusters(bbox, zoom)
+    response = {'longitude': np.round(clusters['longitude'], 6).tolist(),
+                'latitude': np.round(clusters['latitude'], 6).tolist(),
+                'count': clusters['count'].tolist(),
+                'cluster': clusters['cluster'].tolist()}
+    # Popups are only shown for single photos.
+    single = clusters['count'] == 1
+    for column in photos.columns:
+        values = np.full(len(single), None, dtype=object)
+        values[single] = photos[column].values[clusters['row'][single]]
+        response[column] = values.tolist()
+    return flask.jsonify(**response)
+
+
+@app.route('/tiles/<search_term>/<int:z>/<int:x>/<int:y>')
+def tiles_page(search_term, z, x, y):
+    """Aggregates of search results in map tile `z`/`x`/`y`, encoded with
+    `tiling.encode_tile`."""
+    key = database.canonical_phrase(search_term)
+    tile = tile_cache.get((key, z, x, y))
+    if tile is None:
+        lod = get_point_hierarchy(search_term)
+        if lod is None:
+            flask.abort(404)
+        hierarchy = lod[0]
+        # Beyond `max_zoom` tiles only split points further apart, so bound
+        # the zoom before computing the number of tiles.
+        if not (0 <= z <= hierarchy.max_zoom + 8 and
+                0 <= x < 2**z and 0 <= y < 2**z):
+            flask.abort(404)
+        tile = tiling.encode_tile(hierarchy.get_tile(z, x, y))
+        tile_cache.put((key, z, x, y), tile)
+    response = flask.Response(tile, mimetype='application/octet-stream')
+    # Tiles of a query don't change while the data doesn't, so let browsers
+    # reuse them for as long as rendered maps are cached.
+    response.cache_control.public = True
+    response.cache_control.max_age = map_cache.ttl
+    return response
 
 
 @app.route('/output')
@@ -53,16 +296,22 @@ def map_page():
     # If user leaves the search bar blank, use "CN Tower".
     if search_term == "":
         search_term = "CN Tower"
-    map_TO_root = get_search_results(search_term)
-    if map_TO_root is None:
+    map_TO_render = get_map_html(search_term)
+    if map_TO_render is None:
         return flask.render_template("input.html", err_message=(
             "Sorry, couldn't find anything with those keywords."))
-    map_TO_render = map_TO_root.render()
-    # Hack to remove adding redundant bootstrap CSS files.
-    map_TO_render = re.sub(bad_css, '', map_TO_render)
     return flask.render_template("output.html", map_TO=map_TO_render)
 
 
+@app.route('/cachestats')
+def cache_stats_page():
+    return flask.jsonify(search=search_cache.stats(),
+                         clusters=cluster_cache.stats(),
+                         maps=map_cache.stats(),
+                         lod=lod_cache.stats(),
+                         tiles=tile_cache.stats())
+
+
 @app.route('/about')
 def about_page():
     return flask.render_template("about.html")